@@ -3,180 +3,363 @@
 from __future__ import print_function
 import os
 import sys
-import glob
-import tarfile
-from random import randint
+import argparse
+import multiprocessing
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy
 from sklearn import svm
-from sklearn.grid_search import GridSearchCV
+from sklearn.model_selection import GridSearchCV, StratifiedKFold
 from sklearn.metrics import roc_curve, auc, roc_auc_score
-from sklearn.feature_selection import SelectPercentile, f_classif, chi2, SelectKBest
+from sklearn.metrics.pairwise import euclidean_distances
 
+import fea_store
+import fea_select
+import ensemble_fld
 
-# {{{ untar_to_tmpdir()
-def untar_to_tmpdir(tar_file):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import svm_search
+import memory
+import model_cache
 
-   dirname=os.path.basename(os.path.splitext(tar_file)[0])
-   tmpdir1="/tmp/"+str(random.randint(10000000,99999999))
-   tmpdir2="/tmp/"+str(random.randint(10000000,99999999))
-   tar = tarfile.open(tar_file)
-   tar.extractall(tmpdir1)
-   tar.close()
 
-   # remove one level
-   shutil.move(tmpdir1+'/'+dirname, tmpdir2)
-   shutil.rmtree(tmpdir1)
+# >> CONFIGURATION >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+# Grid search strategy:
+# - 'exhaustive': GridSearchCV, one RBF SVC (and kernel) per cell and fold
+# - 'precomputed': one Gram matrix per gamma, reused for every C and fold
+# - 'halving': coarse-to-fine search on growing subsamples
+GRID_SEARCH_MODE='precomputed'
+
+# Number of concurrent threads (grid search and FLD ensemble)
+NUMBER_OF_PROCESSES=cpu_count()
+
+# Type of the feature matrices. numpy.float32 halves the memory of the
+# float64 path (--dtype in the command line).
+FLOAT_DTYPE=numpy.float32
+
+# Images of B classified by every prediction job
+PREDICT_CHUNK_ROWS=2048
+
+# Keep the grid searches and the fitted SVMs in the on-disk cache of
+# common/model_cache.py, so reruns on the same A and C skip them
+# (--no-cache in the command line)
+MODEL_CACHE=True
+
+
+# <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
-   return tmpdir2
-# }}}
 
 # {{{ read_SRM()
-def read_SRM(path):
-
-   remove_path=False
-   if not os.path.isdir(path):
-      path=untar_to_tmpdir(path)
-      remove_path=True
-
-   directory = glob.glob(path+"/*")
-
-   submodel_X={}
-   submodel_names={}                               
-   
-   i=0
-   for d in directory:
-     i+=1
-     files = glob.glob(d+"/*.fea")
-     for f in files:
-       model_name=os.path.splitext(os.path.basename(f))[0]
-       features=open(f, 'r').readlines()[0].split(' ');
-     
-       if model_name not in submodel_X.keys():
-         submodel_X[model_name]=[]
-         submodel_names[model_name]=[]      
-   
-
-       submodel_names[model_name].append(os.path.basename(d))
-
-       fea_line=[]
-       features.pop()
-       for field in features:
-         try:
-            fea_line.append(float(field))
-         except:
-            pass
-
-       if len(submodel_X[model_name]) == 0:
-         submodel_X[model_name]=[]
-       submodel_X[model_name].append(fea_line)
-
-   for k in submodel_X.keys():
-      submodel_X[k]=numpy.array(submodel_X[k])
-
-   if remove_path:
-      shutil.rmtree(path)
-
-   return submodel_X, submodel_names
+# Returns the (images x features) matrix, the image names and the list of
+# (submodel, width) column blocks. Images and submodels are sorted by name.
+def read_SRM(path, dtype=None):
+   if dtype is None:
+      dtype=FLOAT_DTYPE
+   return fea_store.read_set(path, dtype)
+# }}}
+
+# {{{ check_ABC()
+# The rows and the columns of the three sets must line up: the same images
+# in the same order and the same submodels
+def check_ABC(A_names, B_names, C_names, A_submodels, B_submodels, C_submodels):
+
+   if B_submodels!=A_submodels or C_submodels!=A_submodels:
+      raise ValueError("A, B and C do not have the same submodels")
+
+   for s, names in (("A", A_names), ("C", C_names)):
+      if names!=B_names:
+         diff=sorted(set(names).symmetric_difference(B_names))
+         if len(diff)==0:
+            raise ValueError("%s and B have the images in a different order"
+                             % s)
+         raise ValueError("%s and B do not have the same images (%d differ, "
+                          "e.g. %s)" % (s, len(diff), ", ".join(diff[:5])))
 # }}}
 
 # {{{ read_SRM_ABC()
-def read_SRM_ABC( pathA, pathB, pathC):
-
-   A, A_names=read_SRM(pathA)
-   B, B_names=read_SRM(pathB)
-   C, C_names=read_SRM(pathC)
-
-   full_A=[]
-   full_B=[]
-   full_C=[]
-   names=[]
-   for k in A.keys():
-      if len(full_A)==0:
-         full_A=A[k]
-         full_B=B[k]
-         full_C=C[k]
-         names=A_names[k]
-         continue
-
-      full_A=numpy.append(full_A, A[k], axis=1)
-      full_B=numpy.append(full_B, B[k], axis=1)
-      full_C=numpy.append(full_C, C[k], axis=1)
+def read_SRM_ABC( pathA, pathB, pathC, dtype=None):
+
+   full_A, A_names, submodels=read_SRM(pathA, dtype)
+   full_B, names, B_submodels=read_SRM(pathB, dtype)
+   full_C, C_names, C_submodels=read_SRM(pathC, dtype)
+
+   check_ABC(A_names, names, C_names, submodels, B_submodels, C_submodels)
 
+   # names are the ones of B, the set we classify
    return full_A, full_B, full_C, names
 # }}}
 
-# {{{ grid_search()
-def grid_search(X, y):
+# {{{ open_SRM_ABC()
+# Same as read_SRM_ABC(), but the sets are lists of column blocks that are
+# memory mapped when they come from a feature store (see fea_select.py)
+def open_SRM_ABC( pathA, pathB, pathC, dtype=None):
 
-   # Set the parameters by cross-validation
-   tuned_parameters = [{'kernel': ['rbf'], 
-                         'gamma': [1e+3,1e-2,1e-1,1e-0,1e-1,1e-2,1e-3,1e-4],
-                        'C': [0.25,0.5,1,10,100,10000]}]
+   if dtype is None:
+      dtype=FLOAT_DTYPE
+   A, A_names, submodels=fea_store.open_set(pathA, dtype)
+   B, names, B_submodels=fea_store.open_set(pathB, dtype)
+   C, C_names, C_submodels=fea_store.open_set(pathC, dtype)
 
-   clf = GridSearchCV(svm.SVC(C=1), tuned_parameters)
-   clf.fit(X, y)
-   
-   best_score=0
-   best_params={}
-   for params, mean_score, scores in clf.grid_scores_:
-      if mean_score>best_score:
-         best_score=mean_score
-         best_params=params
+   check_ABC(A_names, names, C_names, submodels, B_submodels, C_submodels)
 
-   #print "best_score: %r" % best_score
-   #print "best_params: %r" % best_params
+   return A, B, C, names
+# }}}
 
-   return best_params
+# {{{ svm_cache()
+def svm_cache():
+   if MODEL_CACHE:
+      return model_cache.default_cache()
+   return None
 # }}}
 
-if len(sys.argv) < 4:
-   print("%s <A> <B> <C> <labels>\n" % sys.argv[0])
-   sys.exit(0)
+# {{{ grid_search()
+def grid_search(X, y, mode=None):
 
-directory_A=sys.argv[1]
-directory_B=sys.argv[2]
-directory_C=sys.argv[3]
+   if mode is None:
+      mode=GRID_SEARCH_MODE
 
-A, B, C, names = read_SRM_ABC(directory_A, directory_B, directory_C)
+   # Set the parameters by cross-validation
+   tuned_parameters = [{'kernel': ['rbf'], 
+                         'gamma': [1e+3,1e-2,1e-1,1e-0,1e-1,1e-2,1e-3,1e-4],
+                        'C': [0.25,0.5,1,10,100,10000]}]
 
-X=numpy.vstack((A, C))
-Xt=numpy.hstack(([0]*len(A), [1]*len(C)))
+   if mode not in ('precomputed', 'halving', 'exhaustive'):
+      raise ValueError("Unknown grid search mode: "+str(mode))
 
-selector = SelectKBest(f_classif, k=500)
-selector.fit(X, Xt)
-X=selector.transform(X)
-B=selector.transform(B)
+   def search():
+      if mode=='precomputed':
+         return grid_search_precomputed(X, y, tuned_parameters[0]['gamma'], 
+                                        tuned_parameters[0]['C'])
 
+      if mode=='halving':
+         return svm_search.halving_search(X, y, tuned_parameters[0]['gamma'],
+                                          tuned_parameters[0]['C'], n_jobs=-1)
 
-pm = grid_search(X, Xt)
-clf = svm.SVC(kernel=pm['kernel'], C=pm['C'], gamma=pm['gamma'])
-clf.fit(X, Xt)
+      clf = GridSearchCV(svm.SVC(C=1), tuned_parameters)
+      clf.fit(X, y)
 
-Z = clf.predict(B)
+      #print "best_score: %r" % clf.best_score_
+      #print "best_params: %r" % clf.best_params_
 
-# Calculate accuracy
-if len(sys.argv)==5 and os.path.exists(sys.argv[4]):
-    with open(sys.argv[4], 'r') as f:
-        lines = f.read().splitlines()
-    d={}
-    for l in lines:
-        pair=l.split(":")
-        d[pair[0]]=pair[1]
+      return clf.best_params_
 
-    ok=0
-    for i in range(len(Z)):
-        if int(d[names[i]]) == Z[i]: ok+=1
+   return model_cache.cached(svm_cache(),
+      model_cache.key('grid_search', mode, tuned_parameters, X, y), search)
+# }}}
 
-    print("Accuracy: ", float(ok)/len(Z))
+# {{{ grid_search_precomputed()
+# Same search as GridSearchCV on an RBF SVC, but the squared distances are
+# computed once, the Gram matrix once per unique gamma, and every fold and
+# C value is fitted on slices of it with a precomputed kernel. The gammas
+# are processed one at a time, reusing one Gram matrix buffer, and the
+# folds of each gamma run in a thread pool sharing it.
+def grid_search_precomputed(X, y, gammas, Cs, n_folds=5, processes=None):
+
+   y=numpy.asarray(y)
+   gammas=sorted(set(gammas), key=gammas.index)
+   folds=list(StratifiedKFold(n_splits=n_folds).split(X, y))
+   D=euclidean_distances(X, squared=True)
+   K=numpy.empty_like(D)
+
+   def fit_fold(fold):
+      train, test=fold
+      K_train=K[numpy.ix_(train, train)]
+      K_test=K[numpy.ix_(test, train)]
+      scores=[]
+      for C in Cs:
+         clf=svm.SVC(kernel='precomputed', C=C)
+         clf.fit(K_train, y[train])
+         scores.append(numpy.mean(clf.predict(K_test)==y[test]))
+      return scores
+
+   if processes is None:
+      processes=NUMBER_OF_PROCESSES
+   pool=ThreadPool(processes=min(processes, len(folds)))
+   results=[]
+   for g in gammas:
+      numpy.multiply(D, -g, out=K)
+      numpy.exp(K, out=K)
+      results+=[(g, scores) for scores in pool.map(fit_fold, folds)]
+   pool.close()
+   pool.join()
+
+   mean_scores=dict((g, numpy.zeros(len(Cs))) for g in gammas)
+   for g, scores in results:
+      mean_scores[g]+=numpy.array(scores)/len(folds)
+
+   best_score=-1
+   best_params={}
+   for g in gammas:
+      for i, C in enumerate(Cs):
+         if mean_scores[g][i]>best_score:
+            best_score=mean_scores[g][i]
+            best_params={'kernel': 'rbf', 'gamma': g, 'C': C}
 
+   return best_params
+# }}}
+
+# {{{ train()
+# Train the classifier with A as cover and C as stego, both lists of column
+# blocks. Returns the columns it uses and the fitted classifier.
+def train(A, C, classifier='svm', dtype=None):
+
+   if dtype is None:
+      dtype=FLOAT_DTYPE
+   n_features=sum(blocks.shape[1] for blocks in A)
+   nA=len(A[0])
+   nC=len(C[0])
+
+   # The FLD ensemble uses all the features. The SVM uses the best 500
+   # ones by ANOVA, computed over chunks of rows, so only the selected
+   # columns of A and C are loaded.
+   if classifier=='fld':
+      cols=numpy.arange(n_features)
+   else:
+      cols=fea_select.select_k_best([A, C], min(500, n_features))
+
+   # A and C are gathered straight into the training matrix
+   X=numpy.empty((nA+nC, len(cols)), dtype=dtype)
+   fea_select.gather(A, cols, out=X[:nA])
+   fea_select.gather(C, cols, out=X[nA:])
+   Xt=numpy.hstack(([0]*nA, [1]*nC))
+
+   if classifier=='fld':
+      clf = ensemble_fld.EnsembleFLD(n_jobs=NUMBER_OF_PROCESSES)
+      clf.fit(X, Xt)
+      print("OOB error: ", clf.oob_error_, file=sys.stderr)
+
+   else:
+      pm = grid_search(X, Xt)
+
+      def fit():
+         clf = svm.SVC(kernel=pm['kernel'], C=pm['C'], gamma=pm['gamma'])
+         clf.fit(X, Xt)
+         return clf
+
+      clf = model_cache.cached(svm_cache(),
+         model_cache.key('SVC', pm, X, Xt), fit)
+
+   return cols, clf
+# }}}
 
-# Make a prediction
-else:
-    for i in range(len(Z)):
-        r='cover'
-        if Z[i]==1: r='stego'
-        print(names[i], r)
+# {{{ predict_chunk()
+# Runs in the prediction workers. The model and B are not sent to them:
+# they are inherited from the parent when the pool is forked.
+PREDICT_SHARED=None
 
+def predict_chunk(bounds):
+   clf, B=PREDICT_SHARED
+   start, end=bounds
+   return start, clf.decision_function(B[start:end])
+# }}}
+
+# {{{ predict_chunked()
+# Decision scores of the rows of B, computed in chunks of rows by a pool
+# of forked processes. Yields (first row, scores) as the chunks finish.
+def predict_chunked(clf, B, chunk_rows=None, processes=None):
+
+   global PREDICT_SHARED
+
+   if chunk_rows is None:
+      chunk_rows=PREDICT_CHUNK_ROWS
+   if processes is None:
+      processes=NUMBER_OF_PROCESSES
+
+   n=len(B)
+   chunks=[(s, min(s+chunk_rows, n)) for s in range(0, n, chunk_rows)]
+
+   if processes==1 or len(chunks)<=1:
+      for start, end in chunks:
+         yield start, clf.decision_function(B[start:end])
+      return
+
+   PREDICT_SHARED=(clf, B)
+   pool=multiprocessing.get_context('fork').Pool(processes=processes)
+   try:
+      for result in pool.imap_unordered(predict_chunk, chunks):
+         yield result
+   finally:
+      pool.close()
+      pool.join()
+      PREDICT_SHARED=None
+# }}}
 
+# {{{ main()
+def main():
+   parser = argparse.ArgumentParser(
+      usage="%(prog)s [--classifier svm|fld] [--dtype float32|float64] "
+            "[--output file] [--no-cache] <A> <B> <C> [labels]")
+   parser.add_argument("A")
+   parser.add_argument("B")
+   parser.add_argument("C")
+   parser.add_argument("labels", nargs='?')
+   parser.add_argument("--classifier", choices=['svm', 'fld'], default='svm',
+      help="svm: RBF SVM on 500 selected features, "
+           "fld: ensemble of FLDs on all the features")
+   parser.add_argument("--dtype", choices=['float32', 'float64'],
+      default=numpy.dtype(FLOAT_DTYPE).name,
+      help="type of the feature matrices")
+   parser.add_argument("--output",
+      help="write the name, verdict, decision score and label of every "
+           "image of B to this file")
+   parser.add_argument("--no-cache", action='store_true',
+      help="do not use the cache of grid searches and fitted SVMs")
+   args = parser.parse_args()
+   dtype=numpy.dtype(args.dtype)
+
+   global MODEL_CACHE
+   if args.no_cache:
+      MODEL_CACHE=False
+
+   A, B, C, names = open_SRM_ABC(args.A, args.B, args.C, dtype)
+   cols, clf = train(A, C, args.classifier, dtype)
+
+   labels=None
+   if args.labels is not None and os.path.exists(args.labels):
+      with open(args.labels, 'r') as f:
+         lines = f.read().splitlines()
+      d={}
+      for l in lines:
+         pair=l.split(":")
+         d[pair[0]]=pair[1]
+      labels=numpy.array([int(d[n]) for n in names])
+
+   out=None
+   if args.output is not None:
+      out=open(args.output, 'w')
+
+   # The results are written as the chunks finish, so the order of the
+   # images in the output is not the order of B
+   scores=numpy.empty(len(names))
+   for start, s in predict_chunked(clf, fea_select.gather(B, cols, dtype)):
+      scores[start:start+len(s)]=s
+      for i in range(start, start+len(s)):
+         r='cover'
+         if scores[i]>0: r='stego'
+
+         if out is not None:
+            label='-' if labels is None else str(labels[i])
+            out.write("%s %s %f %s\n" % (names[i], r, scores[i], label))
+
+         # Make a prediction
+         if labels is None:
+            print(names[i], r)
+
+   if out is not None:
+      out.close()
+
+   # Calculate accuracy
+   if labels is not None:
+      Z=(scores>0).astype(int)
+      print("Accuracy: ", numpy.mean(Z==labels))
+      if len(numpy.unique(labels))==2:
+         print("AUC: ", roc_auc_score(labels, scores))
+
+   memory.report_peak_memory(args.dtype)
+# }}}
 
 
+if __name__ == "__main__":
+   main()
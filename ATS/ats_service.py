@@ -0,0 +1,345 @@
+#!/usr/bin/python -W ignore
+# -*- coding: utf-8 -*-
+
+# Classification service for ATS.
+#
+# ATS_SVM_FS.py trains the classifier from scratch on every run. Here the
+# classifier is trained once, saved to a model file, and served by a long
+# running process that keeps it in memory:
+#
+#   ./ats_service.py train [--classifier svm|fld] <A> <C> <model file>
+#   ./ats_service.py serve [--socket <path>|--port <port>] <model file>
+#   ./ats_service.py classify [--socket <path>|--port <port>] <image> ...
+#
+# The service listens on a Unix socket (or on a localhost TCP port) and
+# speaks JSON lines. Each request is one JSON object in one line:
+#
+#   {"images": ["/path/img1.pgm", ...]}
+#   {"features": [[...], ...], "names": ["img1", ...]}
+#   {"stats": true}
+#
+# and gets one JSON line back with a "results" list of name, verdict
+# (cover or stego) and decision score, or with the counters of the service.
+# Images that can not be processed get an "error" in their result instead,
+# and requests that can not be read, an "error" reply.
+# Feature vectors have all the features of the sets used for training, in
+# the column order of the feature store. Images are decoded and their
+# features extracted in a process pool, with the extractor of the training
+# sets.
+
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import pickle
+import shutil
+import argparse
+import asyncio
+import numpy
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+
+import fea_store
+import fea_select
+import executor
+import images
+import prepare_ABC_sets
+import ATS_SVM_FS
+
+
+# >> CONFIGURATION >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+# Default Unix socket of the service
+SOCKET_PATH="/tmp/ats_service.sock"
+
+# Processes used to extract the features of the images
+NUMBER_OF_PROCESSES=cpu_count()
+
+# Maximum size of a request line (feature vectors can be large)
+MAX_REQUEST_SIZE=2**28
+
+
+# <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+
+# {{{ train_model()
+# Train the classifier of ATS_SVM_FS.py on the sets A and C and save it,
+# with the selected columns and the layout of the features, to model_file
+def train_model(pathA, pathC, model_file, classifier='svm', dtype=None):
+
+    if dtype is None:
+        dtype=ATS_SVM_FS.FLOAT_DTYPE
+
+    A, A_names, submodels=fea_store.open_set(pathA, dtype)
+    C, C_names, C_submodels=fea_store.open_set(pathC, dtype)
+    if C_submodels!=submodels:
+        raise ValueError("A and C do not have the same submodels")
+
+    cols, clf=ATS_SVM_FS.train(A, C, classifier, dtype)
+
+    # PPD sets have a single PPD submodel, the rest come from the SRM tool
+    fea_ext='PPD' if [k for k, w in submodels]==['PPD'] else 'RM'
+
+    model={'cols': cols, 'clf': clf, 'submodels': submodels,
+           'fea_ext': fea_ext, 'dtype': numpy.dtype(dtype).name}
+
+    tmp=model_file+".tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, model_file)
+    return model
+# }}}
+
+# {{{ load_model()
+def load_model(model_file):
+    with open(model_file, 'rb') as f:
+        return pickle.load(f)
+# }}}
+
+# {{{ image_features()
+# Runs in the workers. Features of an image with the columns of the model.
+def image_features(f, fea_ext, submodels):
+
+    name=prepare_ABC_sets.extract_name_from_file(f)
+    odir=executor.scratch_dir("svc_")
+    f_pgm=images.to_pgm(f, executor.scratch_file(name, ".pgm"))
+    try:
+        prepare_ABC_sets.extract_features(fea_ext, f_pgm, odir, name)
+        return fea_store.process_fea_image((odir+"/"+name, submodels,
+                                            numpy.float32))
+    finally:
+        os.remove(f_pgm)
+        shutil.rmtree(odir, ignore_errors=True)
+# }}}
+
+# {{{ Service
+class Service(object):
+
+    def __init__(self, model, processes=None):
+        self.model=model
+        self.n_features=sum(w for k, w in model['submodels'])
+        self.dtype=numpy.dtype(model['dtype'])
+        self.pool=ProcessPoolExecutor(max_workers=processes or
+                                      NUMBER_OF_PROCESSES)
+
+        self.started=time.time()
+        self.requests=0
+        self.errors=0
+        self.image_errors=0
+        self.classified=0
+        self.latency_total=0.0
+        self.latency_max=0.0
+
+    # Verdicts and decision scores of a matrix with all the features
+    def classify(self, X):
+        X=numpy.asarray(X, dtype=self.dtype)
+        if X.ndim!=2 or X.shape[1]!=self.n_features:
+            raise ValueError("feature vectors must have %d values"
+                             % self.n_features)
+
+        X=fea_select.gather([X], self.model['cols'], self.dtype)
+        scores=self.model['clf'].decision_function(X)
+        return [("stego" if s>0 else "cover", float(s)) for s in scores]
+
+    def stats(self):
+        uptime=time.time()-self.started
+        done=max(1, self.requests)
+        return {'uptime': uptime,
+                'requests': self.requests,
+                'errors': self.errors,
+                'image_errors': self.image_errors,
+                'classified': self.classified,
+                'images_per_second': self.classified/uptime,
+                'mean_latency': self.latency_total/done,
+                'max_latency': self.latency_max}
+
+    async def process(self, request):
+        loop=asyncio.get_running_loop()
+
+        if request.get('stats'):
+            return {'stats': self.stats()}
+
+        errors={}
+        if 'images' in request:
+            paths=request['images']
+            names=[prepare_ABC_sets.extract_name_from_file(f) for f in paths]
+            rows=await asyncio.gather(*[
+                loop.run_in_executor(self.pool, image_features, f,
+                                     self.model['fea_ext'],
+                                     self.model['submodels'])
+                for f in paths], return_exceptions=True)
+
+            # An image that can not be read fails alone, not the batch
+            for i, r in enumerate(rows):
+                if isinstance(r, Exception):
+                    errors[i]=str(r) or type(r).__name__
+            X=numpy.array([r for i, r in enumerate(rows) if i not in errors])
+        elif 'features' in request:
+            X=request['features']
+            names=request.get('names') or [str(i) for i in range(len(X))]
+            if len(names)!=len(X):
+                raise ValueError("%d names for %d feature vectors"
+                                 % (len(names), len(X)))
+        else:
+            raise ValueError("a request needs images, features or stats")
+
+        results=[]
+        if len(X)>0:
+            results=await loop.run_in_executor(None, self.classify, X)
+        self.classified+=len(results)
+        self.image_errors+=len(errors)
+
+        response=[]
+        results=iter(results)
+        for i, n in enumerate(names):
+            if i in errors:
+                response.append({'name': n, 'error': errors[i]})
+            else:
+                v, s=next(results)
+                response.append({'name': n, 'verdict': v, 'score': s})
+        return {'results': response}
+
+    # Next request line, None at the end of the stream. A line longer than
+    # MAX_REQUEST_SIZE is skipped up to its end and raises ValueError, so
+    # the client gets an error and the next request is read normally.
+    async def read_request(self, reader):
+        oversized=False
+        while True:
+            try:
+                line=await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                if oversized or not e.partial:
+                    return None
+                line=e.partial
+            except asyncio.LimitOverrunError as e:
+                await reader.readexactly(max(1, e.consumed))
+                oversized=True
+                continue
+
+            if oversized:
+                raise ValueError("request longer than %d bytes"
+                                 % MAX_REQUEST_SIZE)
+            return line
+
+    async def handle_client(self, reader, writer):
+        while True:
+            start=time.time()
+            try:
+                line=await self.read_request(reader)
+                if line is None:
+                    break
+                response=await self.process(json.loads(line.decode()))
+            except Exception as e:
+                self.errors+=1
+                response={'error': str(e)}
+
+            elapsed=time.time()-start
+            self.requests+=1
+            self.latency_total+=elapsed
+            self.latency_max=max(self.latency_max, elapsed)
+            response['seconds']=elapsed
+
+            writer.write((json.dumps(response)+"\n").encode())
+            await writer.drain()
+
+        writer.close()
+
+    async def serve(self, socket_path=None, port=None):
+        if port is not None:
+            server=await asyncio.start_server(self.handle_client, '127.0.0.1',
+                                              port, limit=MAX_REQUEST_SIZE)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server=await asyncio.start_unix_server(self.handle_client,
+                                                   socket_path,
+                                                   limit=MAX_REQUEST_SIZE)
+        async with server:
+            await server.serve_forever()
+# }}}
+
+# {{{ request()
+# Send one request to a running service and return its response
+def request(message, socket_path=None, port=None):
+
+    async def send():
+        if port is not None:
+            reader, writer=await asyncio.open_connection(
+                '127.0.0.1', port, limit=MAX_REQUEST_SIZE)
+        else:
+            reader, writer=await asyncio.open_unix_connection(
+                socket_path, limit=MAX_REQUEST_SIZE)
+        writer.write((json.dumps(message)+"\n").encode())
+        await writer.drain()
+        response=await reader.readline()
+        writer.close()
+        return json.loads(response.decode())
+
+    return asyncio.run(send())
+# }}}
+
+# {{{ main()
+def main():
+    parser=argparse.ArgumentParser()
+    commands=parser.add_subparsers(dest='command')
+
+    p=commands.add_parser('train', help="train and save a model")
+    p.add_argument("A")
+    p.add_argument("C")
+    p.add_argument("model")
+    p.add_argument("--classifier", choices=['svm', 'fld'], default='svm')
+    p.add_argument("--dtype", choices=['float32', 'float64'],
+                   default=numpy.dtype(ATS_SVM_FS.FLOAT_DTYPE).name)
+
+    p=commands.add_parser('serve', help="serve a model")
+    p.add_argument("model")
+    p.add_argument("--processes", type=int, default=NUMBER_OF_PROCESSES)
+
+    p=commands.add_parser('classify', help="classify images with a service")
+    p.add_argument("images", nargs='+')
+
+    p=commands.add_parser('stats', help="counters of a service")
+
+    for name in ['serve', 'classify', 'stats']:
+        commands.choices[name].add_argument("--socket", default=SOCKET_PATH)
+        commands.choices[name].add_argument("--port", type=int)
+
+    args=parser.parse_args()
+
+    if args.command=='train':
+        train_model(args.A, args.C, args.model, args.classifier,
+                    numpy.dtype(args.dtype))
+        print("Model written to:", args.model)
+
+    elif args.command=='serve':
+        service=Service(load_model(args.model), args.processes)
+        print("Serving", args.model, "on",
+              "port %d" % args.port if args.port else args.socket)
+        sys.stdout.flush()
+        asyncio.run(service.serve(args.socket, args.port))
+
+    elif args.command=='classify':
+        paths=[os.path.abspath(f) for f in args.images]
+        response=request({'images': paths}, args.socket, args.port)
+        if 'error' in response:
+            print("Error:", response['error'])
+            sys.exit(1)
+        for r in response['results']:
+            if 'error' in r:
+                print(r['name'], "error:", r['error'])
+            else:
+                print(r['name'], r['verdict'], "%.6f" % r['score'])
+
+    elif args.command=='stats':
+        response=request({'stats': True}, args.socket, args.port)
+        for k, v in sorted(response['stats'].items()):
+            print(k, v)
+
+    else:
+        parser.print_help()
+# }}}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Ensemble of Fisher Linear Discriminants on random feature subspaces, as
+# proposed by Kodovsky, Fridrich and Holub for rich models. Every base
+# learner is trained on a bootstrap sample of the images using a random
+# subset of the features, so the images left out of the sample give an
+# out-of-bag (OOB) estimate of the error. The final decision is a majority
+# vote. Training is linear in the number of images and does not need any
+# feature selection.
+
+from __future__ import print_function
+import numpy
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+# {{{ fld()
+# Fisher Linear Discriminant of two classes. Returns the projection vector
+# and the threshold halfway between the projected class means.
+def fld(X0, X1, reg=1e-6):
+
+    # The subspaces are small, so the scatter matrix is always solved in
+    # double precision, even for float32 features
+    X0=numpy.asarray(X0, dtype=numpy.float64)
+    X1=numpy.asarray(X1, dtype=numpy.float64)
+
+    m0=X0.mean(axis=0)
+    m1=X1.mean(axis=0)
+    S=numpy.dot((X0-m0).T, X0-m0)+numpy.dot((X1-m1).T, X1-m1)
+
+    # Regularization relative to the scale of the scatter matrix
+    d=S.shape[0]
+    S.flat[::d+1]+=reg*numpy.trace(S)/d+1e-12
+    w=numpy.linalg.solve(S, m1-m0)
+
+    threshold=(numpy.dot(m0, w)+numpy.dot(m1, w))/2
+    return w, threshold
+# }}}
+
+# {{{ EnsembleFLD
+class EnsembleFLD(object):
+
+    def __init__(self, n_learners=51, d_sub=1000, n_jobs=None, seed=0):
+        self.n_learners=n_learners
+        self.d_sub=d_sub
+        self.n_jobs=n_jobs
+        self.seed=seed
+
+    def fit(self, X, y):
+        y=numpy.asarray(y)
+        n, d=X.shape
+        d_sub=min(self.d_sub, d)
+        rs=numpy.random.RandomState(self.seed)
+
+        # Draw all the random choices here, so results do not depend on
+        # the order in which the threads run
+        tasks=[]
+        for l in range(self.n_learners):
+            subspace=numpy.sort(rs.choice(d, d_sub, replace=False))
+            bootstrap=numpy.concatenate([
+                rs.choice(numpy.where(y==c)[0], numpy.sum(y==c))
+                for c in (0, 1)])
+            tasks.append((subspace, bootstrap))
+
+        def train(task):
+            subspace, bootstrap=task
+            # Only the rows and columns of the learner are copied
+            Xb=X[numpy.ix_(bootstrap, subspace)]
+            yb=y[bootstrap]
+            w, threshold=fld(Xb[yb==0], Xb[yb==1])
+            return subspace, bootstrap, w, threshold
+
+        n_jobs=self.n_jobs or cpu_count()
+        pool=ThreadPool(processes=n_jobs)
+        results=pool.map(train, tasks)
+        pool.close()
+        pool.join()
+
+        self.learners_=[(s, w, t) for s, b, w, t in results]
+
+        # Out-of-bag error: every image is classified by the learners
+        # that did not see it during training
+        votes=numpy.zeros(n)
+        counts=numpy.zeros(n)
+        for subspace, bootstrap, w, threshold in results:
+            oob=numpy.ones(n, dtype=bool)
+            oob[bootstrap]=False
+            oob_rows=numpy.nonzero(oob)[0]
+            p=numpy.dot(X[numpy.ix_(oob_rows, subspace)], w)>threshold
+            votes[oob]+=p
+            counts[oob]+=1
+
+        seen=counts>0
+        oob_pred=(votes[seen]/counts[seen])>0.5
+        self.oob_error_=numpy.mean(oob_pred!=y[seen])
+        return self
+
+    def decision_function(self, X):
+        # Fraction of learners voting stego, centered at zero
+        votes=numpy.zeros(X.shape[0])
+        for subspace, w, threshold in self.learners_:
+            votes+=numpy.dot(X[:, subspace], w)>threshold
+        return votes/len(self.learners_)-0.5
+
+    def predict(self, X):
+        return (self.decision_function(X)>0).astype(int)
+# }}}
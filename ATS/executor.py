@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Execution of the embedding and feature extraction jobs used by
+# gen_testing_set.py and prepare_ABC_sets.py.
+#
+# - run() calls the external tools with an argument list and raises an
+#   exception when they fail, instead of ignoring their exit status.
+# - scratch_dir() and scratch_file() place temporary images in SCRATCH_DIR,
+#   a RAM backed directory when available.
+# - Executor wraps a process pool, limits the number of jobs in flight and
+#   records the result and the time of every job.
+
+from __future__ import print_function
+import os
+import time
+import random
+import tempfile
+import threading
+import subprocess
+import traceback
+from multiprocessing import Pool, cpu_count
+
+
+# >> CONFIGURATION >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+# Directory for temporary images and tool outputs
+SCRATCH_DIR="/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# Maximum number of jobs submitted and not finished, per process
+JOBS_IN_FLIGHT_PER_PROCESS=4
+
+
+# <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+
+# {{{ run()
+def run(args):
+    p=subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err=p.communicate()
+    if p.returncode!=0:
+        raise RuntimeError("%s failed with exit status %d: %s"
+                           % (os.path.basename(args[0]), p.returncode,
+                              err.decode(errors='replace').strip()[-500:]))
+    return out
+# }}}
+
+# {{{ scratch_dir()
+def scratch_dir(prefix="ats_"):
+    return tempfile.mkdtemp(prefix=prefix, dir=SCRATCH_DIR)
+# }}}
+
+# {{{ scratch_file()
+def scratch_file(name, suffix):
+    fd, path=tempfile.mkstemp(prefix=name+"_", suffix=suffix, dir=SCRATCH_DIR)
+    os.close(fd)
+    return path
+# }}}
+
+# {{{ process_job()
+# Runs in the workers. It never raises, so the parent always gets the time
+# spent and the error message of failed jobs.
+def process_job(func, args):
+    start=time.time()
+    try:
+        func(*args)
+        return True, "", time.time()-start
+    except Exception as e:
+        msg=str(e) or traceback.format_exc().strip().splitlines()[-1]
+        return False, msg, time.time()-start
+# }}}
+
+# {{{ init_worker()
+def init_worker():
+    # Forked workers inherit the same random state, so without this they
+    # would use the same embedding keys
+    random.seed()
+# }}}
+
+# {{{ Executor
+class Executor(object):
+
+    def __init__(self, processes=None, max_in_flight=None):
+        if processes is None:
+            processes=cpu_count()
+        if max_in_flight is None:
+            max_in_flight=JOBS_IN_FLIGHT_PER_PROCESS*processes
+
+        self.pool=Pool(processes=processes, initializer=init_worker)
+        self.slots=threading.BoundedSemaphore(max_in_flight)
+        self.lock=threading.Lock()
+        self.results=[]
+
+    # Blocks while there are too many jobs in flight. callback(ok, error)
+    # is called in this process when the job finishes.
+    def submit(self, name, func, args, callback=None):
+
+        self.slots.acquire()
+
+        def done(result):
+            ok, error, seconds=result
+            with self.lock:
+                self.results.append((name, ok, error, seconds))
+            if not ok:
+                print("Error processing", name, ":", error)
+            try:
+                if callback is not None:
+                    callback(ok, error)
+            finally:
+                self.slots.release()
+
+        def failed(e):
+            done((False, str(e), 0.0))
+
+        self.pool.apply_async(process_job, args=(func, args),
+                              callback=done, error_callback=failed)
+
+    def join(self):
+        self.pool.close()
+        self.pool.join()
+        return self.results
+
+    def failures(self):
+        return [r for r in self.results if not r[1]]
+
+    def summary(self):
+        n=len(self.results)
+        failed=len(self.failures())
+        total=sum(r[3] for r in self.results)
+        mean=total/n if n>0 else 0
+        return "%d jobs, %d ok, %d failed, %.2fs per job" % (n, n-failed,
+                                                            failed, mean)
+
+    # One "<name> <ok|failed> <seconds> <error>" line per job
+    def write_log(self, path):
+        with open(path, "w") as f:
+            for name, ok, error, seconds in self.results:
+                f.write("%s %s %.3f %s\n" % (name, "ok" if ok else "failed",
+                                             seconds, error))
+# }}}
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Out-of-core ANOVA feature selection.
+#
+# The same selection as SelectKBest(f_classif, k), but the F statistic is
+# computed from per-class sums and sums of squares accumulated over chunks
+# of rows, and only the k selected columns are gathered. The sets are lists
+# of column blocks (see fea_store.open_set()), usually memory mapped, so the
+# full (images x features) matrix is never in memory.
+
+from __future__ import print_function
+import numpy
+
+
+# >> CONFIGURATION >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+# Rows read at once from every block
+CHUNK_ROWS=1024
+
+
+# <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+
+# {{{ column_sums()
+# Number of rows, sum, sum of squares, minimum and maximum of every column
+# of a set
+def column_sums(blocks, chunk_rows=None):
+
+    if chunk_rows is None:
+        chunk_rows=CHUNK_ROWS
+
+    s1, s2, mn, mx=[], [], [], []
+    for X in blocks:
+        b1=numpy.zeros(X.shape[1])
+        b2=numpy.zeros(X.shape[1])
+        bmn=numpy.full(X.shape[1], numpy.inf)
+        bmx=numpy.full(X.shape[1], -numpy.inf)
+        for r in range(0, X.shape[0], chunk_rows):
+            chunk=numpy.asarray(X[r:r+chunk_rows], dtype=numpy.float64)
+            b1+=chunk.sum(axis=0)
+            b2+=(chunk*chunk).sum(axis=0)
+            bmn=numpy.minimum(bmn, chunk.min(axis=0))
+            bmx=numpy.maximum(bmx, chunk.max(axis=0))
+        s1.append(b1)
+        s2.append(b2)
+        mn.append(bmn)
+        mx.append(bmx)
+
+    return (blocks[0].shape[0], numpy.concatenate(s1), numpy.concatenate(s2),
+            numpy.concatenate(mn), numpy.concatenate(mx))
+# }}}
+
+# {{{ anova_f()
+# One-way ANOVA F statistic of every column, one set per class, as
+# sklearn's f_classif
+def anova_f(sets, chunk_rows=None):
+
+    stats=[column_sums(blocks, chunk_rows) for blocks in sets]
+
+    n=sum(s[0] for s in stats)
+    total=sum(s[1] for s in stats)
+    ss_all=sum(s[2] for s in stats)
+
+    ss_tot=ss_all-total**2/n
+    ss_between=sum(s[1]**2/s[0] for s in stats)-total**2/n
+    ss_within=ss_tot-ss_between
+
+    df_between=len(sets)-1
+    df_within=n-len(sets)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        F=(ss_between/df_between)/(ss_within/df_within)
+
+    # Constant features have no F, even when the rounding errors of the
+    # sums do not cancel exactly
+    mn=numpy.min([s[3] for s in stats], axis=0)
+    mx=numpy.max([s[4] for s in stats], axis=0)
+    F[mn==mx]=numpy.nan
+    return F
+# }}}
+
+# {{{ select_k_best()
+# Sorted indices of the k columns with the highest F, with the same ties
+# and NaN handling as SelectKBest
+def select_k_best(sets, k, chunk_rows=None):
+
+    F=anova_f(sets, chunk_rows)
+    F[numpy.isnan(F)]=numpy.finfo(F.dtype).min
+
+    k=min(k, len(F))
+    return numpy.sort(numpy.argsort(F, kind='mergesort')[len(F)-k:])
+# }}}
+
+# {{{ gather()
+# Matrix with the given columns of a set, read in chunks of rows. The
+# columns are written into out when given, for instance a slice of a
+# larger matrix, so the sets can be stacked without copies.
+def gather(blocks, cols, dtype=numpy.float32, out=None, chunk_rows=None):
+
+    if chunk_rows is None:
+        chunk_rows=CHUNK_ROWS
+
+    n=blocks[0].shape[0]
+    if out is None:
+        out=numpy.empty((n, len(cols)), dtype=dtype)
+
+    # Columns of every block and their position in the output
+    start=0
+    for X in blocks:
+        w=X.shape[1]
+        pos=numpy.nonzero((cols>=start) & (cols<start+w))[0]
+        if len(pos)>0:
+            local=cols[pos]-start
+            for r in range(0, n, chunk_rows):
+                out[r:r+chunk_rows, pos]=X[r:r+chunk_rows][:, local]
+        start+=w
+
+    return out
+# }}}
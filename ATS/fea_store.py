@@ -0,0 +1,310 @@
+#!/usr/bin/python -W ignore
+# -*- coding: utf-8 -*-
+
+# Binary feature store.
+#
+# A store is a directory with:
+#   names.txt       one image name per line (row order)
+#   submodels.txt   one submodel name per line (column block order)
+#   <submodel>.npy  float32 matrix (images x submodel features)
+#
+# The .npy files are loaded with memory mapping, so opening a store is
+# almost free and only the columns actually used are read from disk.
+
+from __future__ import print_function
+import sys
+import os
+import glob
+import shutil
+import tarfile
+import numpy
+from multiprocessing import Pool, cpu_count
+
+
+STORE_SUFFIX=".store"
+
+
+# {{{ is_store()
+def is_store(path):
+    return os.path.isfile(os.path.join(path, "submodels.txt"))
+# }}}
+
+# {{{ store_path()
+# Default location of the store associated to a .fea directory
+def store_path(fea_dir):
+    return os.path.normpath(fea_dir)+STORE_SUFFIX
+# }}}
+
+# {{{ parse_fea()
+# A .fea file has the features in its first line separated by spaces and
+# followed by the image name.
+def parse_fea(text, dtype=numpy.float32):
+    line=text.split('\n', 1)[0].rstrip('\r')
+    return numpy.fromstring(line.rsplit(' ', 1)[0], dtype=dtype, sep=' ')
+# }}}
+
+# {{{ list_fea_dir()
+# Images (subdirectories) and submodels of a .fea directory, both sorted so
+# that rows and columns are always in the same order for A, B and C.
+def list_fea_dir(path):
+
+    images=sorted(d for d in glob.glob(path+"/*") if os.path.isdir(d))
+    if len(images)==0:
+        raise ValueError("no images found in "+path)
+
+    submodels=[]
+    for f in sorted(glob.glob(images[0]+"/*.fea")):
+        model_name=os.path.splitext(os.path.basename(f))[0]
+        with open(f, 'r') as fd:
+            submodels.append((model_name, len(parse_fea(fd.read()))))
+
+    return images, submodels
+# }}}
+
+# {{{ process_fea_image()
+def process_fea_image(args):
+    d, submodels, dtype=args
+
+    row=[]
+    for model_name, width in submodels:
+        f=d+"/"+model_name+".fea"
+        if not os.path.isfile(f):
+            raise ValueError("missing submodel %s in %s" % (model_name, d))
+        with open(f, 'r') as fd:
+            fea=parse_fea(fd.read(), dtype)
+        if len(fea)!=width:
+            raise ValueError("%s has %d features, expected %d"
+                             % (f, len(fea), width))
+        row.append(fea)
+
+    return numpy.concatenate(row)
+# }}}
+
+# {{{ read_fea_dir()
+# Read a directory with one subdirectory per image and one .fea file per
+# submodel inside each of them. Returns the full (images x features)
+# matrix, the image names and the list of (submodel, width) column blocks.
+def read_fea_dir(path, dtype=numpy.float32, processes=None):
+
+    # First pass: final shape
+    images, submodels=list_fea_dir(path)
+    names=[os.path.basename(d) for d in images]
+    X=numpy.empty((len(images), sum(w for m, w in submodels)), dtype=dtype)
+
+    # Second pass: parse in parallel, writing each row into its place
+    pool=Pool(processes=processes)
+    jobs=[(d, submodels, dtype) for d in images]
+    chunksize=max(1, len(jobs)//(4*(processes or cpu_count())))
+    for i, row in enumerate(pool.imap(process_fea_image, jobs, chunksize)):
+        X[i]=row
+    pool.close()
+    pool.join()
+
+    return X, names, submodels
+# }}}
+
+# {{{ to_matrix()
+# Pack a {submodel: matrix} dictionary into a single preallocated matrix,
+# with submodels and images sorted by name.
+def to_matrix(submodel_X, submodel_names, dtype=numpy.float32):
+
+    if len(submodel_X)==0:
+        raise ValueError("no submodels found")
+
+    keys=sorted(submodel_X.keys())
+    names=sorted(submodel_names[keys[0]])
+    submodels=[(k, submodel_X[k].shape[1]) for k in keys]
+    X=numpy.empty((len(names), sum(w for m, w in submodels)), dtype=dtype)
+
+    c=0
+    for k, w in submodels:
+        if sorted(submodel_names[k])!=names:
+            raise ValueError("submodel %s does not cover the same images" % k)
+        order=numpy.argsort(submodel_names[k], kind='mergesort')
+        X[:, c:c+w]=submodel_X[k][order]
+        c+=w
+
+    return X, names, submodels
+# }}}
+
+# {{{ read_fea_tar()
+# Read a tarball of a set directory. The archive is read as a stream in a
+# single pass and nothing is written to disk. Returns a dictionary with a
+# matrix per submodel and another one with the image names of its rows.
+def read_fea_tar(tar_file):
+
+    submodel_X={}
+    submodel_names={}
+    submodel_rows={}
+
+    tar=tarfile.open(tar_file, 'r|*')
+    for member in tar:
+        if not member.isfile() or not member.name.endswith(".fea"):
+            continue
+
+        model_name=os.path.splitext(os.path.basename(member.name))[0]
+        image_name=os.path.basename(os.path.dirname(member.name))
+        fea_line=parse_fea(tar.extractfile(member).read().decode())
+
+        if model_name not in submodel_X:
+            submodel_X[model_name]=numpy.empty((64, len(fea_line)),
+                                               dtype=numpy.float32)
+            submodel_names[model_name]=[]
+            submodel_rows[model_name]=0
+
+        # The number of images is not known until the end of the stream,
+        # so the buffers double their capacity when they are full.
+        X=submodel_X[model_name]
+        r=submodel_rows[model_name]
+        if r==X.shape[0]:
+            X=numpy.resize(X, (2*X.shape[0], X.shape[1]))
+            submodel_X[model_name]=X
+
+        X[r]=fea_line
+        submodel_rows[model_name]=r+1
+        submodel_names[model_name].append(image_name)
+
+    tar.close()
+
+    for k in submodel_X.keys():
+        submodel_X[k]=submodel_X[k][:submodel_rows[k]]
+
+    return submodel_X, submodel_names
+# }}}
+
+# {{{ write_store()
+def write_store(path, names, submodel_X, submodels=None):
+
+    if submodels is None:
+        submodels=sorted(submodel_X.keys())
+
+    # Write into a temporary directory and rename it at the end, so a
+    # crash never leaves a half written store that looks valid.
+    tmp=os.path.normpath(path)+".tmp"
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    with open(tmp+"/names.txt", "w") as f:
+        for n in names:
+            f.write(n+"\n")
+
+    with open(tmp+"/submodels.txt", "w") as f:
+        for k in submodels:
+            X=numpy.asarray(submodel_X[k], dtype=numpy.float32)
+            if X.shape[0]!=len(names):
+                raise ValueError("submodel %s has %d rows, expected %d"
+                                 % (k, X.shape[0], len(names)))
+            numpy.save(tmp+"/"+k+".npy", X)
+            f.write(k+"\n")
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+# }}}
+
+# {{{ read_store()
+# Returns a dictionary with a memory mapped float32 matrix per submodel and
+# another one with the image names of its rows.
+def read_store(path, mmap_mode='r'):
+
+    with open(path+"/names.txt", "r") as f:
+        names=f.read().splitlines()
+
+    with open(path+"/submodels.txt", "r") as f:
+        submodels=f.read().splitlines()
+
+    submodel_X={}
+    submodel_names={}
+    for k in submodels:
+        submodel_X[k]=numpy.load(path+"/"+k+".npy", mmap_mode=mmap_mode)
+        submodel_names[k]=names
+
+    return submodel_X, submodel_names
+# }}}
+
+# {{{ read_set()
+# Read a set as a (images x features) matrix, with its image names and
+# (submodel, width) column blocks. path can be a store, a .fea directory
+# (its store is used when it exists) or a tarball of a .fea directory.
+def read_set(path, dtype=numpy.float32):
+
+    if is_store(path):
+        return to_matrix(*read_store(path), dtype=dtype)
+
+    if os.path.isdir(path) and is_store(store_path(path)):
+        return to_matrix(*read_store(store_path(path)), dtype=dtype)
+
+    if not os.path.isdir(path):
+        return to_matrix(*read_fea_tar(path), dtype=dtype)
+
+    return read_fea_dir(path, dtype)
+# }}}
+
+# {{{ open_set()
+# Like read_set(), but without loading the features of a store. Returns a
+# list with one (memory mapped) matrix per submodel, in the column order
+# of read_set(), the image names and the (submodel, width) column blocks.
+# Sets that are not stores are read in memory, as dtype, and split into
+# blocks.
+def open_set(path, dtype=numpy.float32):
+
+    if not is_store(path) and os.path.isdir(path) and \
+       is_store(store_path(path)):
+        path=store_path(path)
+
+    if is_store(path):
+        submodel_X, submodel_names=read_store(path)
+        keys=sorted(submodel_X.keys())
+        names=submodel_names[keys[0]]
+        if names==sorted(names):
+            return ([submodel_X[k] for k in keys], names,
+                    [(k, submodel_X[k].shape[1]) for k in keys])
+
+    X, names, submodels=read_set(path, dtype)
+    blocks=[]
+    c=0
+    for k, w in submodels:
+        blocks.append(X[:, c:c+w])
+        c+=w
+    return blocks, names, submodels
+# }}}
+
+# {{{ fea_dir_to_store()
+def fea_dir_to_store(fea_dir, path=None):
+
+    if path is None:
+        path=store_path(fea_dir)
+
+    if os.path.isdir(fea_dir):
+        X, names, submodels=read_fea_dir(fea_dir)
+    else:
+        X, names, submodels=to_matrix(*read_fea_tar(fea_dir))
+
+    submodel_X={}
+    c=0
+    for k, w in submodels:
+        submodel_X[k]=X[:, c:c+w]
+        c+=w
+
+    write_store(path, names, submodel_X, [k for k, w in submodels])
+    return path
+# }}}
+
+# {{{ main()
+def main():
+    if len(sys.argv) < 2:
+        print("%s <fea dir|tar file> [store dir]\n" % sys.argv[0])
+        sys.exit(0)
+
+    fea_dir=sys.argv[1]
+    path=None
+    if len(sys.argv) > 2:
+        path=sys.argv[2]
+
+    print("Store written to:", fea_dir_to_store(fea_dir, path))
+# }}}
+
+
+if __name__ == "__main__":
+    main()
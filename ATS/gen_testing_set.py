@@ -7,8 +7,12 @@ import os
 import shutil
 import glob
 import random
-from multiprocessing import Pool, cpu_count
-from scipy import misc
+from multiprocessing import cpu_count
+
+import executor
+import images
+import lsbm
+import shards
 
 
 # >> CONFIGURATION >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
@@ -27,24 +31,32 @@ NUMBER_OF_PROCESSES=cpu_count()
 # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
 # {{{ process_embedding()
-def process_embedding(f_pgm, algo, br, f_dst, output_dir):
-    hide_message(f_pgm, algo, br, output_dir)
-    os.rename(f_pgm, f_dst)
+def process_embedding(f, algo, br, f_dst):
+    f_pgm=to_tmp_pgm(f)
+    try:
+        hide_message(f_pgm, algo, br)
+        shutil.move(f_pgm, f_dst)
+    finally:
+        if os.path.exists(f_pgm):
+            os.remove(f_pgm)
+
+# }}}
 
+# {{{ process_cover()
+def process_cover(f, f_dst):
+    images.to_pgm(f, f_dst)
 # }}}
 
 # {{{ to_tmp_pgm()
-def to_tmp_pgm(f, output_dir):
+def to_tmp_pgm(f):
     fn=extract_name_from_file(f)
-    tmp=output_dir+"/tmp/"+fn+"_"+str(random.randint(10000000,99999999))+".pgm"
-    I=misc.imread(f);
-    misc.imsave(tmp, I);
-    return tmp
+    tmp=executor.scratch_file(fn, ".pgm")
+    return images.to_pgm(f, tmp)
 # }}}
 
 # {{{ read_image_filenames()
 def read_image_filenames(base_dir):
-    files = glob.glob(base_dir+"/*.pgm") # +glob.glob(base_dir+"/*.tif")
+    files = glob.glob(base_dir+"/*.pgm")+glob.glob(base_dir+"/*.tif")
     return files
 # }}}
 
@@ -56,68 +68,54 @@ def extract_name_from_file(f):
 # }}}
 
 # {{{ hide_message()
-def hide_message(f, algo, br, output):
- 
-    global HUGO_BIN
-    global WOW_BIN
-    global UNIW_BIN
-    br_str=str(br)
+# Embed a random message into f, which is overwritten with the stego image
+def hide_message(f, algo, br):
+
+    # LSB matching is done in-process, without calling any tool
+    if algo=="LSBM":
+        lsbm.embed_file(f, br, random.randint(0, 2**32-1))
+        return
+
+    tools={"HUGO": HUGO_BIN, "UNIW": UNIW_BIN, "WOW": WOW_BIN}
+    if algo not in tools:
+        raise ValueError("Unknown algorithm: "+algo)
+
+    tool=tools[algo]
+    if not os.path.exists(tool):
+        raise RuntimeError("command not found: "+tool)
 
     seed=str( random.randint(-(2**31-1), 2**31-1) )
 
-    if algo=="HUGO":
-        if not os.path.exists(HUGO_BIN):
-            print("FATAL ERROR: command not found:", HUGO_BIN)
-            return -1
-
-        filename=extract_name_from_file(f)
-        rdir=output+"/tmp/out_"+str(random.randint(10000000,99999999))
-        os.makedirs(rdir)
-        os.system(HUGO_BIN+" -r "+seed+" -i "+f+" -O "+rdir+" -a "+br_str)
-        os.rename(rdir+"/"+os.path.basename(f), f)
-        shutil.rmtree(rdir)
-
-    elif algo=="UNIW":
-        if not os.path.exists(UNIW_BIN):
-            print("FATAL ERROR: command not found:", UNIW_BIN)
-            return -1
-
-        filename=extract_name_from_file(f)
-        rdir=output+"/tmp/out_"+str(random.randint(10000000,99999999))
-        os.makedirs(rdir)
-        os.system(UNIW_BIN+" -r "+seed+" -i "+f+" -O "+rdir+" -a "+br_str)
-        os.rename(rdir+"/"+os.path.basename(f), f)
-        shutil.rmtree(rdir)
-
-    elif algo=="WOW":         
-        if not os.path.exists(WOW_BIN):
-            print("FATAL ERROR: command not found:", WOW_BIN)
-            return -1
-
-        filename=extract_name_from_file(f)
-        rdir=output+"/tmp/out_"+str(random.randint(10000000,99999999))
-        os.makedirs(rdir)
-        os.system(WOW_BIN+" -r "+seed+" -i "+f+" -O "+rdir+" -a "+br_str)
-        os.rename(rdir+"/"+os.path.basename(f), f)
-        shutil.rmtree(rdir)
-
-    else:
-        print("FATAL ERROR: Unknown algorithm")
-        return -1
+    rdir=executor.scratch_dir("out_")
+    try:
+        executor.run([tool, "-r", seed, "-i", f, "-O", rdir, "-a", str(br)])
+        shutil.move(rdir+"/"+os.path.basename(f), f)
+    finally:
+        shutil.rmtree(rdir, ignore_errors=True)
+# }}}
+
+# {{{ label_writer()
+# Callback of a job that adds its image to labels.txt once the image is
+# written, so images that failed are not labelled
+def label_writer(image_dir, fname, label):
+    def write(ok, error):
+        if ok:
+            with open(image_dir+"/labels.txt", "a+") as myfile:
+                myfile.write("%s:%d\n" % (fname, label))
+    return write
 # }}}
 
 # {{{ gen_testing_set()
-def gen_testing_set(cover_dir, perc_stego, algo, bitrate, output_dir):
+# With shard=(i, N) only the images of shard i are generated (see shards.py)
+def gen_testing_set(cover_dir, perc_stego, algo, bitrate, output_dir, 
+                    shard=None):
  
     global NUMBER_OF_PROCESSES
-    pool=Pool(processes=NUMBER_OF_PROCESSES) 
+    jobs=executor.Executor(processes=NUMBER_OF_PROCESSES)
 
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
 
-    if not os.path.isdir(output_dir+'/tmp'):
-        os.mkdir(output_dir+'/tmp')
-
     if not os.path.isdir(cover_dir):
         print("FATAL ERROR: cover dir does not exists:", cover_dir)
         sys.exit(0)
@@ -140,54 +138,56 @@ def gen_testing_set(cover_dir, perc_stego, algo, bitrate, output_dir):
     os.mkdir(out_cover_dir)
     out_stego_dir=image_dir+'/stego'
     os.mkdir(out_stego_dir)
+    open(image_dir+"/labels.txt", "w").close()
 
-    files = read_image_filenames(cover_dir)
-    n=1
+    # The stego images are chosen from the sorted list of all the images,
+    # so all the shards agree on them
+    files = sorted(read_image_filenames(cover_dir))
+    n=0
     for f in files:
+        n+=1
         sys.stdout.flush()
         fname=extract_name_from_file(f)
-        f_pgm=to_tmp_pgm(f, output_dir)
+        if not shards.in_shard(fname, shard):
+            continue
 
         try:
             # Use as stego images the percentage requested and move to output dir
             if n<=len(files)*float(perc_stego)/100:
                 f_dst=out_stego_dir+'/'+fname+'.pgm'
-                with open(image_dir+"/labels.txt", "a+") as myfile:
-                    myfile.write(fname+":1\n")
-
-                r=pool.apply_async(process_embedding, 
-                  args=( f_pgm, algo, bitrate, f_dst, output_dir))
+                jobs.submit(fname, process_embedding, 
+                  ( f, algo, bitrate, f_dst), label_writer(image_dir, fname, 1))
             
-            # Move cover images to output dir
+            # Copy cover images to output dir
             else:
-                with open(image_dir+"/labels.txt", "a+") as myfile:
-                    myfile.write(fname+":0\n")
-                os.rename(f_pgm, out_cover_dir+'/'+fname+'.pgm')
+                jobs.submit(fname, process_cover, 
+                  ( f, out_cover_dir+'/'+fname+'.pgm'),
+                  label_writer(image_dir, fname, 0))
 
-        except Exception, e:
+        except Exception as e:
             print("Error: "+str(e))
             pass
 
-        n+=1
-
-    pool.close()
-    pool.join()
+    jobs.join()
+    print(jobs.summary())
+    jobs.write_log(image_dir+"/jobs.log")
 
 # }}}
 
 # {{{ main()
 def main():
-    if len(sys.argv) < 6:
-        print("%s <cover dir> <stego perc> <output dir> <algo> <bitrate>\n" % sys.argv[0])
+    argv, shard=shards.pop_shard_arg(sys.argv)
+    if len(argv) < 6:
+        print("%s <cover dir> <stego perc> <output dir> <algo> <bitrate> [--shard i/N]\n" % argv[0])
         sys.exit(0)
 
-    cover_dir=sys.argv[1]
-    perc_stego=sys.argv[2]
-    output_dir=sys.argv[3]
-    algo=sys.argv[4]
-    bitrate=float(sys.argv[5])
+    cover_dir=argv[1]
+    perc_stego=argv[2]
+    output_dir=argv[3]
+    algo=argv[4]
+    bitrate=float(argv[5])
 
-    gen_testing_set(cover_dir, perc_stego, algo, bitrate, output_dir)
+    gen_testing_set(cover_dir, perc_stego, algo, bitrate, output_dir, shard)
 # }}}
 
 
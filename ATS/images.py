@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Minimal readers and writers for the grayscale images used by ATS, so the
+# tools do not depend on scipy.misc (removed from SciPy).
+#
+# - PGM: binary (P5) and ASCII (P2), 8 or 16 bits.
+# - TIFF: uncompressed, one sample per pixel, 8 bits, any byte order.
+
+from __future__ import print_function
+import os
+import shutil
+import struct
+import numpy
+
+
+# {{{ read_pgm()
+def read_pgm(f):
+
+    with open(f, 'rb') as fd:
+        data=fd.read()
+
+    # Header: magic, width, height and maxval, with optional comments
+    fields=[]
+    pos=0
+    while len(fields)<4:
+        while data[pos:pos+1].isspace():
+            pos+=1
+        if pos>=len(data):
+            raise ValueError("truncated PGM header: "+f)
+        if data[pos:pos+1]==b'#':
+            pos=data.index(b'\n', pos)+1
+            continue
+        start=pos
+        while pos<len(data) and not data[pos:pos+1].isspace():
+            pos+=1
+        fields.append(data[start:pos])
+    pos+=1
+
+    magic=fields[0]
+    width, height, maxval=[int(v) for v in fields[1:]]
+
+    if magic==b'P5':
+        dtype=numpy.uint8 if maxval<256 else numpy.dtype('>u2')
+        I=numpy.frombuffer(data, dtype=dtype, count=width*height, offset=pos)
+    elif magic==b'P2':
+        I=numpy.array(data[pos:].split(), dtype=numpy.int64)[:width*height]
+        I=I.astype(numpy.uint8 if maxval<256 else numpy.uint16)
+    else:
+        raise ValueError("not a grayscale PGM image: "+f)
+
+    return I.reshape((height, width))
+# }}}
+
+# {{{ write_pgm()
+def write_pgm(f, I):
+    I=numpy.asarray(I)
+    if I.ndim!=2:
+        raise ValueError("only grayscale images can be written as PGM")
+
+    if I.max()>255:
+        maxval=65535
+        data=I.astype('>u2').tobytes()
+    else:
+        maxval=255
+        data=I.astype(numpy.uint8).tobytes()
+
+    # Written to a new file and renamed, so when f is a hard link to
+    # another image (see to_pgm()) that image is not modified
+    tmp=f+".tmp"
+    with open(tmp, 'wb') as fd:
+        fd.write(("P5\n%d %d\n%d\n" % (I.shape[1], I.shape[0], maxval)).encode())
+        fd.write(data)
+    os.rename(tmp, f)
+# }}}
+
+# {{{ read_tiff()
+def read_tiff(f):
+
+    with open(f, 'rb') as fd:
+        data=fd.read()
+
+    if data[:2]==b'II':
+        e='<'
+    elif data[:2]==b'MM':
+        e='>'
+    else:
+        raise ValueError("not a TIFF image: "+f)
+
+    if struct.unpack(e+'H', data[2:4])[0]!=42:
+        raise ValueError("not a TIFF image: "+f)
+
+    # First IFD
+    ifd=struct.unpack(e+'I', data[4:8])[0]
+    n=struct.unpack(e+'H', data[ifd:ifd+2])[0]
+    sizes={1: ('B', 1), 3: ('H', 2), 4: ('I', 4)}
+
+    tags={}
+    for i in range(n):
+        entry=data[ifd+2+12*i:ifd+14+12*i]
+        tag, typ, count=struct.unpack(e+'HHI', entry[:8])
+        if typ not in sizes:
+            continue
+        fmt, size=sizes[typ]
+        if count*size<=4:
+            raw=entry[8:8+count*size]
+        else:
+            off=struct.unpack(e+'I', entry[8:12])[0]
+            raw=data[off:off+count*size]
+        tags[tag]=struct.unpack(e+fmt*count, raw)
+
+    width=tags[256][0]
+    height=tags[257][0]
+    bits=tags.get(258, (1,))[0]
+    compression=tags.get(259, (1,))[0]
+    photometric=tags.get(262, (1,))[0]
+    samples=tags.get(277, (1,))[0]
+
+    if compression!=1 or bits!=8 or samples!=1:
+        raise ValueError("only uncompressed 8 bit grayscale TIFF images "
+                         "are supported: "+f)
+
+    strips=b''.join(data[o:o+c] for o, c in zip(tags[273], tags[279]))
+    I=numpy.frombuffer(strips, dtype=numpy.uint8, count=width*height)
+    I=I.reshape((height, width))
+
+    # WhiteIsZero
+    if photometric==0:
+        I=255-I
+
+    return I
+# }}}
+
+# {{{ read_image()
+def read_image(f):
+    ext=os.path.splitext(f)[1].lower()
+    if ext in ('.pgm', '.pnm'):
+        return read_pgm(f)
+    if ext in ('.tif', '.tiff'):
+        return read_tiff(f)
+    raise ValueError("unsupported image format: "+f)
+# }}}
+
+# {{{ to_pgm()
+# Write f as the PGM image dst. Images that are already PGM are not decoded:
+# they are hard linked or, across file systems, copied.
+def to_pgm(f, dst):
+
+    if os.path.splitext(f)[1].lower()=='.pgm':
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(f, dst)
+        except OSError:
+            shutil.copyfile(f, dst)
+        return dst
+
+    write_pgm(dst, read_image(f))
+    return dst
+# }}}
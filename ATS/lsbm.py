@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+# LSB matching (+-1 embedding) of a random message, done in-process with
+# NumPy. It is the same embedding used by the random embedding step of the
+# PPD features (PPD/ppd_cose.c), but with an exact message length and a
+# seed, so the stego images can be reproduced.
+
+from __future__ import print_function
+import numpy
+
+import images
+
+
+# {{{ embed()
+# Hide a random message of bitrate*pixels bits in a copy of I. Every bit
+# goes to a different pixel and, when the LSB of the pixel does not match
+# the bit, the pixel is randomly incremented or decremented. Pixels at 0
+# and 255 are always moved inwards.
+def embed(I, bitrate, seed=None):
+
+    rs=numpy.random.RandomState(seed)
+    I=numpy.asarray(I)
+    S=I.astype(numpy.int16).ravel()
+
+    n=int(round(float(bitrate)*S.size))
+    n=min(n, S.size)
+    idx=rs.choice(S.size, n, replace=False)
+    bits=rs.randint(0, 2, n)
+    signs=rs.randint(0, 2, n)*2-1
+
+    change=(S[idx]%2)!=bits
+    signs[S[idx]==0]=1
+    signs[S[idx]==255]=-1
+    S[idx[change]]+=signs[change]
+
+    return S.reshape(I.shape).astype(I.dtype)
+# }}}
+
+# {{{ embed_file()
+# Same as embed() for a PGM file, which is overwritten with the stego image
+def embed_file(f, bitrate, seed=None):
+    images.write_pgm(f, embed(images.read_pgm(f), bitrate, seed))
+# }}}
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# NumPy implementation of the PPD features (Patterns of Pixel Differences
+# and random embedding), the same ones computed by PPD/ppd_cose.c:
+#
+#   D. Lerch-Hostalot, D. Megias. "LSB Matching Steganalysis Based on
+#   Patterns of Pixel Differences and Random Embedding" (2013)
+#
+# Every 5 pixel neighbourhood
+#
+#   a b
+#   c d
+#   . e
+#
+# gives two patterns, the differences of the pixels to their minimum and to
+# their maximum, truncated to S-1. The 256 bin histogram of the patterns of
+# the image is compared with the one of the image after a random +-1
+# embedding, and the normalized ratio is the feature vector.
+
+from __future__ import print_function
+import numpy
+
+
+S=4
+
+# For each position of the minimum (or maximum) in (a, b, c, d, e), the
+# positions of its l, c1, c2 and r neighbours, as in count_patterns()
+NEIGHBOURS=numpy.array([
+    [1, 3, 4, 2],   # a: l=b, c1=d, c2=e, r=c
+    [3, 2, 4, 0],   # b: l=d, c1=c, c2=e, r=a
+    [0, 1, 3, 4],   # c: l=a, c1=b, c2=d, r=e
+    [4, 2, 0, 1],   # d: l=e, c1=c, c2=a, r=b
+    [2, 0, 1, 3],   # e: l=c, c1=a, c2=b, r=d
+])
+
+
+# {{{ neighbourhoods()
+# The five pixels of every neighbourhood, shape (5, ..., rows-2, cols-1).
+# I can have leading dimensions, to process several images at once.
+def neighbourhoods(I):
+    I=numpy.asarray(I, dtype=numpy.int16)
+    return numpy.stack([
+        I[..., :-2, :-1],   # a
+        I[..., :-2, 1:],    # b
+        I[..., 1:-1, :-1],  # c
+        I[..., 1:-1, 1:],   # d
+        I[..., 2:, 1:],     # e
+    ])
+# }}}
+
+# {{{ pattern_indices()
+# Flat histogram index of the min and max patterns of every neighbourhood
+def pattern_indices(P):
+
+    weights=numpy.array([S**3, S**2, S, 1]).reshape((4,)+(1,)*(P.ndim-1))
+
+    # argmin/argmax return the first position, as the strict comparisons
+    # of the C implementation
+    indices=[]
+    for pos, sign in ((numpy.argmin(P, axis=0), 1),
+                      (numpy.argmax(P, axis=0), -1)):
+        ref=numpy.take_along_axis(P, pos[None], axis=0)
+        nb=numpy.take_along_axis(P, numpy.moveaxis(NEIGHBOURS[pos], -1, 0),
+                                 axis=0)
+        diff=numpy.minimum(sign*(nb-ref), S-1)
+        indices.append((diff*weights).sum(axis=0))
+
+    return indices
+# }}}
+
+# {{{ count_patterns()
+# 256 bin histogram of the min and max patterns of I. For a stack of
+# images (n, rows, cols) all the histograms are counted in a single pass
+# and an (n, 256) matrix is returned.
+def count_patterns(I):
+    I=numpy.asarray(I)
+    n=int(numpy.prod(I.shape[:-2]))
+    offset=(numpy.arange(n)*S**4).reshape(I.shape[:-2]+(1, 1))
+
+    hist=numpy.zeros(n*S**4, dtype=numpy.int64)
+    for idx in pattern_indices(neighbourhoods(I)):
+        hist+=numpy.bincount((idx+offset).ravel(), minlength=n*S**4)
+    return hist.reshape(I.shape[:-2]+(S**4,))
+# }}}
+
+# {{{ hide_random()
+# Random +-1 embedding with the given bitrate, as message_hide_random_br().
+# Saturated pixels are not modified. With realizations>1 a stack of
+# independent embeddings is returned.
+def hide_random(I, bitrate=1, random_state=None, realizations=None):
+
+    rs=random_state
+    if rs is None or isinstance(rs, int):
+        rs=numpy.random.RandomState(rs)
+
+    I=numpy.asarray(I, dtype=numpy.int16)
+    shape=I.shape
+    if realizations is not None:
+        shape=(realizations,)+I.shape
+
+    br=int(1/bitrate)
+    bits=rs.randint(0, 2, shape)
+    signs=rs.randint(0, 2, shape)*2-1
+    used=rs.randint(0, br, shape)==0
+
+    change=used & (I>0) & (I<255) & ((I%2)!=bits)
+    return I+change*signs
+# }}}
+
+# {{{ ratio_features()
+# Normalized ratio between the histograms of the stego and cover versions.
+# stego can be a stack of histograms, one ratio vector per row.
+def ratio_features(cover, stego):
+    stego=numpy.asarray(stego, dtype=float)
+    R=numpy.zeros(stego.shape)
+    nz=cover>0
+    R[..., nz]=stego[..., nz]/cover[nz]
+
+    mn=R.min(axis=-1, keepdims=True)
+    mx=R.max(axis=-1, keepdims=True)
+    d=numpy.where(mx>mn, mx-mn, 1)
+    return (R-mn)/d
+# }}}
+
+# {{{ ppd_features()
+# PPD features of I. With realizations>1 the ratio is averaged over that
+# many seeded random embeddings, all counted in the same pass, which gives
+# stable features. With variance=True the variance of the ratio over the
+# realizations is appended to the mean (2*256 features).
+def ppd_features(I, seed=None, realizations=1, variance=False):
+    cover=count_patterns(I)
+    stego=count_patterns(hide_random(I, 1, seed, realizations))
+    R=ratio_features(cover, stego)
+
+    if not variance:
+        return R.mean(axis=0)
+    return numpy.concatenate([R.mean(axis=0), R.var(axis=0)])
+# }}}
@@ -7,8 +7,14 @@ import os
 import shutil
 import glob
 import random
-from multiprocessing import Pool, cpu_count
-from scipy import misc
+from multiprocessing import cpu_count
+
+import fea_store
+import executor
+import images
+import lsbm
+import ppd
+import shards
 
 
 # >> CONFIGURATION >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
@@ -23,63 +29,91 @@ UNIW_BIN="bin/S-UNIWARD"
 # Available at http://dde.binghamton.edu/download/feature_extractors/
 RM_BIN="bin/SRM"
 
+# PPD: random embeddings averaged per image, and whether to append the
+# variance of the ratio over them to the features
+PPD_REALIZATIONS=1
+PPD_VARIANCE=False
+
 # Number of concurrent processes
 NUMBER_OF_PROCESSES=cpu_count()
 #NUMBER_OF_PROCESSES=4
 
+# Also write a binary feature store (<set dir>.store) for each set.
+# ATS_SVM_FS.py reads it instead of parsing the .fea files.
+WRITE_FEATURE_STORE=True
+
+# Images already processed in each set, used to resume interrupted runs
+# and to add new images to an existing testing set
+MANIFEST="manifest.txt"
+
 
 # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
 
 
 # {{{ process_extractor()
-def process_extractor(fea_ext, f, output_dir, name, remove=False):
-   extract_features(fea_ext, f, output_dir, name, remove)
+def process_extractor(fea_ext, f, odir, name, cover_dir):
+    extract_features(fea_ext, cached_cover(f, cover_dir), odir, name)
 # }}}
 
 # {{{ process_embed_and_extract()
-def process_embed_and_extract(fea_ext, f_pgm, 
-    name, algo, br, dirB, dirC, output_dir, remove):
-   
-   hide_and_extract(fea_ext, f_pgm, name, algo, br, dirB, dirC, output_dir, remove)
+def process_embed_and_extract(fea_ext, f, name, algo, br, dirB, dirC, 
+                              cover_dir):
+    f_pgm=executor.scratch_file(name, ".pgm")
+    try:
+        shutil.copyfile(cached_cover(f, cover_dir), f_pgm)
+        hide_and_extract(fea_ext, f_pgm, name, algo, br, dirB, dirC)
+    finally:
+        os.remove(f_pgm)
 # }}}
 
 # {{{ hide_and_extract()
 # hide info and extract features
-def hide_and_extract(fea_ext, f_pgm, name, algo, 
-     br, dirB, dirC, output_dir, remove=True):
-    fn = extract_name_from_file(f_pgm)
-
-    f_dst=output_dir+"/tmp/"+fn+"_"+str(random.randint(10000000,99999999))+".pgm"
-    hide_message(f_pgm, algo, br, output_dir)
-    os.rename(f_pgm, f_dst)
-    extract_features(fea_ext, f_dst, dirB, name, False)
+def hide_and_extract(fea_ext, f_pgm, name, algo, br, dirB, dirC):
+    hide_message(f_pgm, algo, br)
+    extract_features(fea_ext, f_pgm, dirB, name)
 
-    hide_message(f_dst, algo, br, output_dir)
-    extract_features(fea_ext, f_dst, dirC, name, remove)
+    hide_message(f_pgm, algo, br)
+    extract_features(fea_ext, f_pgm, dirC, name)
 # }}}
 
 # {{{ extract_features()
 def extract_features(fea_ext, f, odir, name, remove=False):
     if fea_ext=="RM":
         os.makedirs(odir+"/"+name)
-        os.system(RM_BIN+" -i "+f+" -O "+odir+"/"+name)
+        executor.run([RM_BIN, "-i", f, "-O", odir+"/"+name])
+
+    # PPD features are computed in-process, written as a .fea file with
+    # the same layout as the ones of the SRM tool
+    elif fea_ext=="PPD":
+        os.makedirs(odir+"/"+name)
+        fea=ppd.ppd_features(images.read_image(f), random.randint(0, 2**32-1),
+                             PPD_REALIZATIONS, PPD_VARIANCE)
+        with open(odir+"/"+name+"/PPD.fea", "w") as fd:
+            fd.write("".join("%f " % v for v in fea)+name+"\n")
 
     else:
-        print("FATAL ERROR: Unknown feature extractor:", fea_ext)
-        return 0
+        raise ValueError("Unknown feature extractor: "+fea_ext)
 
     if remove:
         os.remove(f)
+
+    # Do not let an image without features reach the manifest
+    if len(glob.glob(odir+"/"+name+"/*.fea"))==0:
+        raise RuntimeError("no features extracted for "+name)
 # }}}
 
-# {{{ to_tmp_pgm()
-def to_tmp_pgm(f, output_dir):
+# {{{ cached_cover()
+# PGM version of f in cover_dir, shared by all the jobs of the image, so
+# every cover is decoded only once per run. Two jobs may decode it at the
+# same time, but the rename only lets complete files be seen.
+def cached_cover(f, cover_dir):
     fn=extract_name_from_file(f)
-    tmp=output_dir+"/tmp/"+fn+"_"+str(random.randint(10000000,99999999))+".pgm"
-    I=misc.imread(f);
-    misc.imsave(tmp, I);
-    return tmp
+    dst=cover_dir+"/"+fn+".pgm"
+    if not os.path.exists(dst):
+        tmp=images.to_pgm(f, executor.scratch_file(fn, ".pgm"))
+        os.rename(tmp, dst)
+    return dst
 # }}}
 
 # {{{ read_image_filenames()
@@ -96,154 +130,255 @@ def extract_name_from_file(f):
 # }}}
 
 # {{{ hide_message()
-def hide_message(f, algo, br, output):
- 
-    global HUGO_BIN
-    global WOW_BIN
-    global UNIW_BIN
-    br_str=str(br)
+# Embed a random message into f, which is overwritten with the stego image
+def hide_message(f, algo, br):
+
+    # LSB matching is done in-process, without calling any tool
+    if algo=="LSBM":
+        lsbm.embed_file(f, br, random.randint(0, 2**32-1))
+        return
+
+    tools={"HUGO": HUGO_BIN, "UNIW": UNIW_BIN, "WOW": WOW_BIN}
+    if algo not in tools:
+        raise ValueError("Unknown algorithm: "+algo)
+
+    tool=tools[algo]
+    if not os.path.exists(tool):
+        raise RuntimeError("command not found: "+tool)
 
     seed=str( random.randint(-(2**31-1), 2**31-1) )
 
-    if algo=="HUGO":
-        if not os.path.exists(HUGO_BIN):
-            print("FATAL ERROR: command not found:", HUGO_BIN)
-            return -1
-
-        filename=extract_name_from_file(f)
-        rdir=output+"/tmp/out_"+str(random.randint(10000000,99999999))
-        os.makedirs(rdir)
-        os.system(HUGO_BIN+" -r "+seed+" -i "+f+" -O "+rdir+" -a "+br_str)
-        os.rename(rdir+"/"+os.path.basename(f), f)
-        shutil.rmtree(rdir)
-
-    elif algo=="UNIW":
-        if not os.path.exists(UNIW_BIN):
-            print("FATAL ERROR: command not found:", UNIW_BIN)
-            return -1
-
-        filename=extract_name_from_file(f)
-        rdir=output+"/tmp/out_"+str(random.randint(10000000,99999999))
-        os.makedirs(rdir)
-        os.system(UNIW_BIN+" -r "+seed+" -i "+f+" -O "+rdir+" -a "+br_str)
-        os.rename(rdir+"/"+os.path.basename(f), f)
-        shutil.rmtree(rdir)
-
-    elif algo=="WOW":         
-        if not os.path.exists(WOW_BIN):
-            print("FATAL ERROR: command not found:", WOW_BIN)
-            return -1
-
-        filename=extract_name_from_file(f)
-        rdir=output+"/tmp/out_"+str(random.randint(10000000,99999999))
-        os.makedirs(rdir)
-        os.system(WOW_BIN+" -r "+seed+" -i "+f+" -O "+rdir+" -a "+br_str)
-        os.rename(rdir+"/"+os.path.basename(f), f)
-        shutil.rmtree(rdir)
+    rdir=executor.scratch_dir("out_")
+    try:
+        executor.run([tool, "-r", seed, "-i", f, "-O", rdir, "-a", str(br)])
+        shutil.move(rdir+"/"+os.path.basename(f), f)
+    finally:
+        shutil.rmtree(rdir, ignore_errors=True)
+# }}}
 
+# {{{ read_manifest()
+# The manifest of a set records the images already processed, one
+# "<name>:<status>" line per attempt. The last line of an image wins.
+def read_manifest(set_dir):
+
+    done={}
+    f=set_dir+"/"+MANIFEST
+    if os.path.exists(f):
+        with open(f, 'r') as fd:
+            for l in fd.read().splitlines():
+                name, _, status=l.rpartition(":")
+                if len(name)>0:
+                    done[name]=status
+
+    # Sets computed before manifests existed: trust the images that have
+    # all the submodels of the set, the ones found in any of its images,
+    # and no empty .fea file. Images left by a crashed extraction are
+    # pending.
     else:
-        print("FATAL ERROR: Unknown algorithm")
-        return -1
+        images={}
+        for d in glob.glob(set_dir+"/*"):
+            fea=glob.glob(d+"/*.fea")
+            if len(fea)>0:
+                images[os.path.basename(d)]=fea
+
+        submodels=set()
+        for fea in images.values():
+            submodels.update(os.path.basename(f) for f in fea)
+
+        for name, fea in images.items():
+            if set(os.path.basename(f) for f in fea)==submodels and \
+               all(os.path.getsize(f)>0 for f in fea):
+                done[name]="ok"
+        for name in sorted(done.keys()):
+            write_manifest(set_dir, name, "ok")
+
+    return done
 # }}}
 
-# {{{ prepare_ABC_sets()
-def prepare_ABC_sets(input_dir, algo, br, output_dir, fea_ext='RM'):
+# {{{ write_manifest()
+def write_manifest(set_dir, name, status):
+    with open(set_dir+"/"+MANIFEST, "a+") as f:
+        f.write(name+":"+status+"\n")
+# }}}
+
+# {{{ pending_images()
+# Images of the testing set not yet done in all the given sets. Leftovers
+# of failed or interrupted runs are removed, so they can be redone.
+def pending_images(files, set_dirs):
+
+    done=[read_manifest(d) for d in set_dirs]
+
+    pending=[]
+    for f in files:
+        fname=extract_name_from_file(f)
+        if all(m.get(fname)=="ok" for m in done):
+            continue
+        for d in set_dirs:
+            if os.path.isdir(d+"/"+fname):
+                shutil.rmtree(d+"/"+fname)
+        pending.append(f)
+
+    return pending
+# }}}
+
+# {{{ set_dirs()
+# Directories of the sets B and C of an algorithm and bitrate
+def set_dirs(label_dir, algo, br):
+    br_str=str(int(float(br)*100)).zfill(3)
+    return (label_dir+'/B_'+algo+'_'+br_str, label_dir+'/C_'+algo+'_'+br_str)
+# }}}
+
+# {{{ prepare_ABC_sweep()
+# Prepare the sets of several (algo, bitrate) configurations of the same
+# testing set in one run. The set A is shared and extracted only once, and
+# the embeddings of all the configurations go to the same pool, so the
+# processes are kept busy across the whole sweep.
+#
+# With shard=(i, N) only the images of shard i are processed (see shards.py)
+def prepare_ABC_sweep(input_dir, configs, output_dir, fea_ext='RM', shard=None):
 
     if input_dir[-1]=='/':
         input_dir=input_dir[:-1]
     label='ATS_'+fea_ext+'_'+os.path.basename(input_dir)
+    label_dir=output_dir+'/'+label
 
     if not os.path.isdir(input_dir):                                                             
         print ("FATAL ERROR: input dir does not exists:", input_dir) 
         sys.exit(0) 
 
-    if not os.path.isdir(output_dir+'/'+label):                                             
-        os.mkdir(output_dir+'/'+label)
+    if not os.path.isdir(label_dir):                                             
+        os.mkdir(label_dir)
 
-    pool=Pool(processes=NUMBER_OF_PROCESSES) 
+    files = read_image_filenames(input_dir);
+    files = [f for f in files if shards.in_shard(extract_name_from_file(f), shard)]
 
     # Al the A sets are the same. We only need one
-    dirA=output_dir+'/'+label+'/A_COMMON'
-    if os.path.isdir(dirA):
-        print("Using data from cache:", dirA)
-
-    else:
+    dirA=label_dir+'/A_COMMON'
+    if not os.path.isdir(dirA):
         os.mkdir(dirA)
-        files = read_image_filenames(input_dir);
-        n=1
-        for f in files:
-            print("A: Extracting", f, "image", n)
-            sys.stdout.flush()
-            fname=extract_name_from_file(f)
 
-            # The set A is the original testing set. 
-            f_pgm=to_tmp_pgm(f, output_dir)
-            r=pool.apply_async(
-                process_extractor, 
-                args=( fea_ext, f_pgm, dirA, fname, True))
-
-            n+=1
+    new_sets=[]
+    pendingA=set(pending_images(files, [dirA]))
+    print("A:", len(files)-len(pendingA), "images from cache,", 
+          len(pendingA), "to extract")
+    if len(pendingA)>0:
+        new_sets.append(dirA)
 
     # Prepare sets B and C
-    br_str=str(int(float(br)*100)).zfill(3)
-    dirB=output_dir+'/'+label+'/B_'+algo+'_'+br_str
-    dirC=output_dir+'/'+label+'/C_'+algo+'_'+br_str
-
-    use_BC_cache=False
-    if os.path.isdir(dirB) and os.path.isdir(dirC):
-        print("Using data from cache:", dirB)
-        print("Using data from cache:", dirC)
-        use_BC_cache=True
-    else:
-        if os.path.isdir(dirB):
-            shutil.rmtree(dirB)
-        if os.path.isdir(dirC):
-            shutil.rmtree(dirC)
-        os.mkdir(dirB)
-        os.mkdir(dirC)
-
-    if not use_BC_cache:
-        files = read_image_filenames(input_dir);
-        n=1
-        for f in files:
-            print("BC: Embedding into", f, "image", n)
-            sys.stdout.flush()
-            fname=extract_name_from_file(f)
-
-            # The set B is the set A with one embedding
-            # The set C is the set A with two embedding
-            try:
-                f_pgm=to_tmp_pgm(f, output_dir)
-                r=pool.apply_async(process_embed_and_extract, args=(
-                    fea_ext,f_pgm,fname,algo,br,dirB,dirC,output_dir,True))
-            
-            except Exception, e:
-                print("Exception hiding data into:", f, ",",str(e))
-                pass
-
-            n+=1
-
-    pool.close()
-    pool.join()
+    sweep=[]
+    for algo, br in configs:
+        dirB, dirC=set_dirs(label_dir, algo, br)
+        for d in [dirB, dirC]:
+            if not os.path.isdir(d):
+                os.mkdir(d)
+
+        pending=set(pending_images(files, [dirB, dirC]))
+        print("BC", algo, br, ":", len(files)-len(pending), 
+              "images from cache,", len(pending), "to embed")
+        if len(pending)>0:
+            new_sets+=[dirB, dirC]
+        sweep.append((algo, br, dirB, dirC, pending))
+
+    # The stores of the sets that change are outdated. They are removed
+    # before any job runs, so an interrupted run never leaves a store that
+    # read_set() would prefer to the .fea files.
+    for d in new_sets:
+        shutil.rmtree(fea_store.store_path(d), ignore_errors=True)
+
+    # The decoded covers of the images in flight. Each one is removed when
+    # the last job of its image finishes.
+    cover_dir=executor.scratch_dir("covers_")
+    remaining={}
+
+    # The manifests are written by the callbacks, which run in this process.
+    # Partial outputs of failed images are removed, so the sets only
+    # contain complete images.
+    def on_done(set_dirs, name):
+        def callback(ok, error):
+            for d in set_dirs:
+                if not ok and os.path.isdir(d+"/"+name):
+                    shutil.rmtree(d+"/"+name)
+                write_manifest(d, name, "ok" if ok else "failed")
+
+            remaining[name]-=1
+            if remaining[name]==0 and os.path.exists(cover_dir+"/"+name+".pgm"):
+                os.remove(cover_dir+"/"+name+".pgm")
+        return callback
+
+    jobs=executor.Executor(processes=NUMBER_OF_PROCESSES)
+
+    # The jobs of every image are submitted together, so only the covers of
+    # the images in flight are kept in the scratch dir
+    n=1
+    for f in files:
+        fname=extract_name_from_file(f)
+        todo=[c for c in sweep if f in c[4]]
+        if f not in pendingA and len(todo)==0:
+            continue
+
+        print("Processing", f, "image", n)
+        sys.stdout.flush()
+        remaining[fname]=len(todo)+(1 if f in pendingA else 0)
+
+        # The set A is the original testing set. 
+        if f in pendingA:
+            jobs.submit("A:"+fname, process_extractor, 
+                ( fea_ext, f, dirA, fname, cover_dir), on_done([dirA], fname))
+
+        # The set B is the set A with one embedding
+        # The set C is the set A with two embedding
+        for algo, br, dirB, dirC, pending in todo:
+            jobs.submit("BC_"+algo+"_"+str(br)+":"+fname, 
+                process_embed_and_extract, (
+                fea_ext,f,fname,algo,br,dirB,dirC,cover_dir), 
+                on_done([dirB, dirC], fname))
+
+        n+=1
+
+    jobs.join()
+    shutil.rmtree(cover_dir, ignore_errors=True)
+    print(jobs.summary())
+    jobs.write_log(label_dir+'/jobs.log')
+
+    if WRITE_FEATURE_STORE:
+        sets=[dirA]+[d for c in sweep for d in c[2:4]]
+        for d in sets:
+            # All the images of the set failed, the log tells why
+            if "ok" not in read_manifest(d).values():
+                print("Feature store not written, no images in", d)
+                continue
+            if d in new_sets or not fea_store.is_store(fea_store.store_path(d)):
+                print("Writing feature store:", fea_store.store_path(d))
+                fea_store.fea_dir_to_store(d)
+
+# }}}
 
+# {{{ prepare_ABC_sets()
+def prepare_ABC_sets(input_dir, algo, br, output_dir, fea_ext='RM', shard=None):
+    prepare_ABC_sweep(input_dir, [(algo, br)], output_dir, fea_ext, shard)
 # }}}
 
 # {{{ main()
+# Algorithms and bitrates can be comma separated lists. All their
+# combinations are prepared in the same run.
 def main():
-    if len(sys.argv) < 5:
-        print("%s <testing set dir> <output dir> <algo> <bitrate>\n" % sys.argv[0])
+    argv, shard=shards.pop_shard_arg(sys.argv)
+    if len(argv) < 5:
+        print("%s <testing set dir> <output dir> <algo[,algo...]> <bitrate[,bitrate...]> [RM|PPD] [--shard i/N]\n" % argv[0])
         sys.exit(0)
 
-    input_dir=sys.argv[1]
-    output_dir=sys.argv[2]
-    algo=sys.argv[3]
-    bitrate=float(sys.argv[4])
+    input_dir=argv[1]
+    output_dir=argv[2]
+    algos=argv[3].split(",")
+    bitrates=[float(br) for br in argv[4].split(",")]
+    fea_ext='RM'
+    if len(argv) > 5:
+        fea_ext=argv[5]
 
-    prepare_ABC_sets(input_dir, algo, bitrate, output_dir)
+    configs=[(algo, br) for algo in algos for br in bitrates]
+    prepare_ABC_sweep(input_dir, configs, output_dir, fea_ext, shard)
 # }}}
 
 
 if __name__ == "__main__":
     main()
-
-
@@ -0,0 +1,203 @@
+#!/usr/bin/python -W ignore
+# -*- coding: utf-8 -*-
+
+# Sharding of gen_testing_set.py and prepare_ABC_sets.py across machines.
+#
+# With "--shard i/N" a run only processes the images whose name hashes to
+# shard i (1 <= i <= N). The hash does not depend on the machine or on the
+# other images, so the nodes do not need any coordination: every node runs
+# the same command with its own shard into its own output dir.
+#
+# The outputs of all the shards are then merged with:
+#
+#   ./shards.py <output dir> <shard output dir> [<shard output dir> ...]
+#
+# which joins the testing sets (cover/, stego/ and labels.txt) and writes
+# one feature store per A, B and C set, the layout read by ATS_SVM_FS.py.
+
+from __future__ import print_function
+import sys
+import os
+import glob
+import shutil
+import hashlib
+import numpy
+
+import fea_store
+
+
+# {{{ parse_shard()
+# "i/N" -> (i, N)
+def parse_shard(spec):
+    try:
+        i, n=[int(v) for v in spec.split("/")]
+    except ValueError:
+        raise ValueError("shard must be i/N: "+spec)
+    if n<1 or i<1 or i>n:
+        raise ValueError("shard must be i/N with 1 <= i <= N: "+spec)
+    return i, n
+# }}}
+
+# {{{ pop_shard_arg()
+# Remove "--shard i/N" from a command line. Returns the remaining arguments
+# and the shard, None when not given.
+def pop_shard_arg(argv):
+    argv=list(argv)
+    if "--shard" not in argv:
+        return argv, None
+    k=argv.index("--shard")
+    if k+1>=len(argv):
+        raise ValueError("--shard needs a value: i/N")
+    shard=parse_shard(argv[k+1])
+    del argv[k:k+2]
+    return argv, shard
+# }}}
+
+# {{{ shard_of()
+# Shard (1..n) of an image name. md5 is used because hash() of strings
+# changes between Python processes.
+def shard_of(name, n):
+    return int(hashlib.md5(name.encode()).hexdigest(), 16)%n+1
+# }}}
+
+# {{{ in_shard()
+def in_shard(name, shard):
+    if shard is None:
+        return True
+    i, n=shard
+    return shard_of(name, n)==i
+# }}}
+
+# {{{ link_or_copy()
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+# }}}
+
+# {{{ merge_testing_sets()
+# Join the testing sets generated by the shards into dst
+def merge_testing_sets(dirs, dst):
+
+    labels={}
+    os.makedirs(dst+"/cover")
+    os.makedirs(dst+"/stego")
+
+    for d in dirs:
+        with open(d+"/labels.txt", "r") as f:
+            for l in f.read().splitlines():
+                name, _, label=l.rpartition(":")
+                if name in labels:
+                    raise ValueError("image %s is in more than one shard" % name)
+                labels[name]=label
+
+        for sub in ["cover", "stego"]:
+            for f in glob.glob(d+"/"+sub+"/*"):
+                link_or_copy(f, dst+"/"+sub+"/"+os.path.basename(f))
+
+    with open(dst+"/labels.txt", "w") as f:
+        for name in sorted(labels.keys()):
+            f.write(name+":"+labels[name]+"\n")
+
+    return len(labels)
+# }}}
+
+# {{{ merge_feature_sets()
+# Join a feature set (A_COMMON, B_*, C_*) of all the shards into the store
+# of dst. The shards must have the same submodels and different images.
+# Returns the image names.
+def merge_feature_sets(dirs, dst):
+
+    blocks=[]
+    all_names=[]
+    submodels=None
+    for d in dirs:
+        X, names, sm=fea_store.read_set(d)
+        if submodels is None:
+            submodels=sm
+        elif sm!=submodels:
+            raise ValueError("%s does not have the same submodels as %s"
+                             % (d, dirs[0]))
+        blocks.append(X)
+        all_names+=names
+
+    if len(set(all_names))!=len(all_names):
+        raise ValueError("some images of %s are in more than one shard"
+                         % os.path.basename(dst))
+
+    order=numpy.argsort(all_names, kind='mergesort')
+    X=numpy.concatenate(blocks)[order]
+    names=[all_names[i] for i in order]
+
+    submodel_X={}
+    c=0
+    for k, w in submodels:
+        submodel_X[k]=X[:, c:c+w]
+        c+=w
+
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    fea_store.write_store(fea_store.store_path(dst), names, submodel_X,
+                          [k for k, w in submodels])
+    return names
+# }}}
+
+# {{{ merge()
+# Merge the output dirs of all the shards into output_dir
+def merge(shard_dirs, output_dir):
+
+    first=shard_dirs[0]
+    for entry in sorted(os.listdir(first)):
+        if not os.path.isdir(first+"/"+entry):
+            continue
+
+        dirs=[d+"/"+entry for d in shard_dirs]
+        for d in dirs:
+            if not os.path.isdir(d):
+                raise ValueError("missing in one of the shards: "+d)
+
+        # Testing set
+        if os.path.isfile(first+"/"+entry+"/labels.txt"):
+            n=merge_testing_sets(dirs, output_dir+"/"+entry)
+            print("Testing set", entry+":", n, "images")
+            continue
+
+        # A, B and C sets of a testing set. All of them must have the same
+        # images, otherwise ATS_SVM_FS.py would mix different images.
+        names=None
+        for s in sorted(os.listdir(first+"/"+entry)):
+            if not os.path.isdir(first+"/"+entry+"/"+s) or \
+               s.endswith(fea_store.STORE_SUFFIX) or s.endswith(".tmp"):
+                continue
+
+            set_names=merge_feature_sets([d+"/"+s for d in dirs],
+                                         output_dir+"/"+entry+"/"+s)
+            print("Feature set", entry+"/"+s+":", len(set_names), "images")
+
+            if names is None:
+                names=set_names
+            elif set_names!=names:
+                raise ValueError("%s/%s does not have the same images as "
+                                 "the other sets" % (entry, s))
+# }}}
+
+# {{{ main()
+def main():
+    if len(sys.argv) < 3:
+        print("%s <output dir> <shard output dir> [<shard output dir> ...]\n" % sys.argv[0])
+        sys.exit(0)
+
+    output_dir=sys.argv[1]
+    shard_dirs=[d.rstrip('/') for d in sys.argv[2:]]
+
+    if os.path.isdir(output_dir) and len(os.listdir(output_dir))>0:
+        print("FATAL ERROR: output dir is not empty:", output_dir)
+        sys.exit(0)
+
+    merge(shard_dirs, output_dir)
+# }}}
+
+
+if __name__ == "__main__":
+    main()
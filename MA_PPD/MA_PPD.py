@@ -2,51 +2,223 @@
 
 from __future__ import print_function
 
+import os
 import sys
+import shutil
+import itertools
 import multiprocessing
 
 from numpy import *
 
 import scipy
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 import scipy.spatial.distance as sd
+from scipy.sparse.csgraph import connected_components
 
 from sklearn import neighbors
 from sklearn import svm
 from sklearn.model_selection import GridSearchCV
 from sklearn import preprocessing
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import svm_search
+import memory
+import model_cache
+
 MAX_PROC=8
 
-# {{{ read_features()
-def read_features(fea_file):
+# Type of the features, graphs and eigenvectors. float32 halves the memory
+# of the distance matrices.
+FLOAT_DTYPE=float64
+
+# Nearest neighbors search of the graphs: 'full' (all the pairwise
+# distances), 'auto', 'kd_tree', 'ball_tree', 'brute' (sklearn, exact) or
+# 'approximate' (inverted file index, for large sets)
+NEIGHBORS='auto'
+
+# Approximate search: clusters searched per point and k-means iterations
+# of the index. 16 probes find about 99% of the exact neighbors.
+APPROX_PROBES=16
+APPROX_ITERATIONS=5
+
+# Dimensions of the aligned manifolds, the number of non-trivial
+# eigenvectors of the Laplacian that are computed
+DIMENSIONS=2
+
+# Incomplete LU factorisation of the Laplacian that preconditions the
+# eigensolver: its fill-in is at most EIGEN_ILU_FILL times the entries of
+# the Laplacian, and the entries smaller than EIGEN_ILU_DROP, relative to
+# their column, are dropped
+EIGEN_ILU_FILL=5
+EIGEN_ILU_DROP=1e-2
+
+# Grid search strategy:
+# - 'exhaustive': GridSearchCV over the full grid
+# - 'halving': coarse-to-fine search on growing subsamples
+GRID_SEARCH_MODE='exhaustive'
+
+# Parallel jobs of the grid search (-1: all the CPUs)
+SVM_JOBS=-1
+
+# Keep a binary copy of every CSV file next to it, memory mapped by the
+# next runs while the CSV does not change
+SIDECAR=True
+SIDECAR_SUFFIX='.sidecar'
+
+# Keep the grid searches and the fitted SVMs in the on-disk cache of
+# common/model_cache.py, so reruns on the same data skip them
+MODEL_CACHE=True
+
+# {{{ pop_dtype_arg()
+# Remove "--dtype float32|float64" from a command line. Returns the
+# remaining arguments and the dtype, None when not given.
+def pop_dtype_arg(argv):
+   argv=list(argv)
+   if "--dtype" not in argv:
+      return argv, None
+   k=argv.index("--dtype")
+   if k+1>=len(argv) or argv[k+1] not in ("float32", "float64"):
+      raise ValueError("--dtype must be float32 or float64")
+   dt=dtype(argv[k+1]).type
+   del argv[k:k+2]
+   return argv, dt
+# }}}
+
+# {{{ csv_columns()
+# Numeric columns of a CSV file, the non-empty fields of its first line
+# except the last one, and the column of the label
+def csv_columns(first_line):
+   fields=first_line.rstrip('\r\n').split(',')
+   last=len(fields)-1
+   return [i for i in range(last) if len(fields[i].strip())>0], last
+# }}}
 
-   fin=open(fea_file, 'r')
-   lines = fin.readlines()
+# {{{ read_csv()
+# Features, labels and names (the last column) of a CSV file, or of the
+# standard input with '-', parsed by numpy in a single pass. The name column
+# goes through a converter that records it and gives the label. Empty
+# inputs have no rows and, as their width is not known, no columns.
+def read_csv(fea_file):
+
+   f = sys.stdin if fea_file=='-' else open(fea_file, 'r')
+   try:
+      # The first non-empty line gives the columns
+      first = ''
+      for first in f:
+         if len(first.strip())>0:
+            break
+      if len(first.strip())==0:
+         return (zeros((0, 0), dtype=FLOAT_DTYPE), zeros(0, dtype=int),
+                 zeros(0, dtype=str))
+
+      cols, last = csv_columns(first)
+      names = []
+      def label(field):
+         names.append(field.strip())
+         return 1 if "stego" in field else 0
+
+      A = loadtxt(itertools.chain([first], f), dtype=FLOAT_DTYPE,
+                  delimiter=',', usecols=cols+[last], converters={last: label},
+                  ndmin=2, comments=None)
+   finally:
+      if f is not sys.stdin:
+         f.close()
+
+   return A[:,:-1], A[:,-1].astype(int), array(names)
+# }}}
 
-   fea=[]
-   label=[]
+# {{{ sidecar_dir()
+# Binary copy of a CSV file: features.npy, labels.npy, names.npy and the
+# size and modification time of the CSV it was made from
+def sidecar_dir(fea_file):
+   return "%s.%s%s" % (fea_file, dtype(FLOAT_DTYPE).name, SIDECAR_SUFFIX)
+# }}}
 
-   i=0
-   for l in lines:
-      features=l.split(',');
-      if "stego" in features[len(features)-1]:
-         label.append(1)
-      else:
-         label.append(0)
+# {{{ csv_signature()
+def csv_signature(fea_file):
+   st=os.stat(fea_file)
+   return "%d %d" % (st.st_size, st.st_mtime_ns)
+# }}}
 
-      fea_line=[]
-      features.pop()
-      for field in features:
-         if len(field)>0:
-            fea_line.append(float(field))
+# {{{ load_sidecar()
+# Memory mapped features, labels and names of a CSV file, None when it has
+# no sidecar or the CSV changed since it was written
+def load_sidecar(fea_file):
+
+   d=sidecar_dir(fea_file)
+   try:
+      with open(os.path.join(d, "source"), 'r') as f:
+         if f.read()!=csv_signature(fea_file):
+            return None
+      return tuple(load(os.path.join(d, n+".npy"), mmap_mode='r')
+                   for n in ("features", "labels", "names"))
+   except (OSError, ValueError):
+      return None
+# }}}
 
-      fea.append(fea_line)
+# {{{ write_sidecar()
+# The sidecar is written to a temporary dir and renamed, so readers never
+# see a partial one
+def write_sidecar(fea_file, signature, X, Xt, names):
+
+   d=sidecar_dir(fea_file)
+   tmp="%s.%d.tmp" % (d, os.getpid())
+   try:
+      os.makedirs(tmp)
+      save(os.path.join(tmp, "features.npy"), X)
+      save(os.path.join(tmp, "labels.npy"), Xt)
+      save(os.path.join(tmp, "names.npy"), names)
+      with open(os.path.join(tmp, "source"), 'w') as f:
+         f.write(signature)
+      if os.path.isdir(d):
+         shutil.rmtree(d)
+      os.rename(tmp, d)
+   except OSError as e:
+      print("Sidecar of", fea_file, "not written:", e, file=sys.stderr)
+      shutil.rmtree(tmp, ignore_errors=True)
+# }}}
 
-   X = array(fea)   
-   Xt = array(label)
+# {{{ load_features()
+# Features, labels and names of one or more CSV files (a list, or paths
+# separated by os.pathsep) read as a single set, in order
+def load_features(fea_file):
+
+   if isinstance(fea_file, (list, tuple)):
+      files=list(fea_file)
+   else:
+      files=fea_file.split(os.pathsep)
+
+   parts=[]
+   for f in files:
+      part=None
+      if SIDECAR and f!='-':
+         part=load_sidecar(f)
+      if part is None:
+         signature=csv_signature(f) if f!='-' else None
+         part=read_csv(f)
+         if SIDECAR and signature is not None:
+            write_sidecar(f, signature, *part)
+      parts.append(part)
+
+   if len(parts)==1:
+      return parts[0]
+
+   # Empty files do not know the number of columns of the others
+   width = max([p[0].shape[1] for p in parts])
+   parts = [p if len(p[1])>0 else (p[0].reshape((0, width)),)+tuple(p[1:])
+            for p in parts]
+
+   return tuple(concatenate([p[i] for p in parts]) for i in range(3))
+# }}}
 
+# {{{ read_features()
+def read_features(fea_file):
+   X, Xt, names = load_features(fea_file)
    return X, Xt
-# }}}}
+# }}}
 
 # {{{ Metric()
 class Metric(object):
@@ -56,7 +228,8 @@ class Metric(object):
 
   def within(self,A):
     '''pairwise distances between each pair of rows in A'''
-    return sd.squareform(sd.pdist(A,self.name),force='tomatrix')
+    return sd.squareform(sd.pdist(A,self.name).astype(A.dtype,copy=False),
+                         force='tomatrix')
 
   def between(self,A,B):
     '''cartesian product distances between pairs of rows in A and B'''
@@ -64,7 +237,7 @@ class Metric(object):
 
   def pairwise(self,A,B):
     '''distances between pairs of rows in A and B'''
-    return np.array([self.dist(a,b) for a,b in izip(A,B)])
+    return array([self.dist(a,b) for a,b in zip(A,B)])
 
 
 SquaredL2 = Metric(sd.sqeuclidean,'sqeuclidean')
@@ -72,73 +245,176 @@ SquaredL2 = Metric(sd.sqeuclidean,'sqeuclidean')
 # }}}
 
 
-# {{{ adjacency_matrix()
-# - W[i,j]=1 when the ith and jth points are neighbors.
-# - Otherwise Wij=0.
-def adjacency_matrix(X, k):
-   # Distances
-   metric=SquaredL2
-   dist = metric.within(X)
+# {{{ nearest_neighbors()
+# Indices and squared distances of the k nearest neighbors of every point,
+# two (n, k+1) matrices. nn's first column is the point idx, rest are
+# neighbor idxs. The backends are:
+# - 'full': all the pairwise distances, sorted (O(n^2) memory)
+# - 'auto', 'kd_tree', 'ball_tree', 'brute': exact search of sklearn
+# - 'approximate': see approximate_neighbors()
+def nearest_neighbors(X, k, backend=None):
 
-   adj = zeros(dist.shape)  
+   if backend is None:
+      backend=NEIGHBORS
+   k = min([k+1, len(X)])
 
-   # k-nearest neighbors
-   nn = argsort(dist)[:,:min(k+1,len(X))]
-   
-   # nn's first column is the point idx, rest are neighbor idxs
-   for idx in nn:
-      adj[idx[0],idx[1:]] = 1
-      adj[idx[1:],idx[0]] = 1
+   if backend=='full':
+      dist = SquaredL2.within(X)
+      nn = argsort(dist)[:,:k]
+      return nn, take_along_axis(dist, nn, axis=1)
+
+   if backend=='approximate':
+      return approximate_neighbors(X, k)
+
+   if backend not in ('auto', 'kd_tree', 'ball_tree', 'brute'):
+      raise ValueError("Unknown neighbors backend: "+str(backend))
+
+   knn = neighbors.NearestNeighbors(n_neighbors=k, algorithm=backend).fit(X)
+   dist, nn = knn.kneighbors(X)
+   return nn, (dist**2).astype(X.dtype)
+# }}}
+
+# {{{ nearest_centroids()
+# Index of the nearest row of C of every row of X, a chunk of rows at a time
+def nearest_centroids(X, C):
+   out = empty(X.shape[0], dtype=int)
+   csq = (C*C).sum(axis=1)
+   chunk = max([1, 2**22//max([1, C.shape[0]])])
+   for s in range(0, X.shape[0], chunk):
+      out[s:s+chunk] = argmin(csq[None,:]-2*dot(X[s:s+chunk], C.T), axis=1)
+   return out
+# }}}
+
+# {{{ approximate_neighbors()
+# Approximate search for large n, where the exact search is quadratic. X is
+# split into about sqrt(n) clusters with a few k-means iterations, and the
+# points of each cluster are compared, with exact distances, only with the
+# points of its APPROX_PROBES nearest clusters (an inverted file index).
+# The work is about APPROX_PROBES*n^1.5 distances instead of n^2. k
+# includes the point.
+def approximate_neighbors(X, k, seed=0):
 
    n = X.shape[0]
-   for i in range(n):
-      for j in range(n):
-         # geodesic distance inside the manifold
-         hk = exp(-(linalg.norm(X[i]-X[j])**2))
-         if adj[i,j]==1:
-            adj[i,j]*=hk
-
-   return adj
+   rs = random.RandomState(seed)
+   m = max([1, int(round(sqrt(n)))])
+   sq = (X*X).sum(axis=1)
+
+   # k-means from m random points
+   C = X[rs.choice(n, m, replace=False)].copy()
+   for it in range(APPROX_ITERATIONS):
+      lab = nearest_centroids(X, C)
+      M = scipy.sparse.csr_matrix((ones(n), (lab, arange(n))), shape=(m, n))
+      counts = bincount(lab, minlength=m)
+      nz = counts>0
+      C[nz] = (M.dot(X)[nz]/counts[nz,None]).astype(X.dtype)
+   lab = nearest_centroids(X, C)
+
+   # Points of every cluster and clusters sorted by distance to every
+   # cluster
+   order = argsort(lab, kind='stable')
+   counts = bincount(lab, minlength=m)
+   start = concatenate(([0], cumsum(counts)))
+   csq = (C*C).sum(axis=1)
+   probe_order = argsort(csq[:,None]+csq[None,:]-2*dot(C, C.T), axis=1)
+
+   nn = empty((n, k), dtype=int)
+   nd = empty((n, k), dtype=X.dtype)
+   for c in range(m):
+      if counts[c]==0:
+         continue
+
+      # At least APPROX_PROBES clusters, and enough points for k
+      probes = []
+      total = 0
+      for p in probe_order[c]:
+         probes.append(p)
+         total += counts[p]
+         if len(probes)>=APPROX_PROBES and total>=k:
+            break
+      cand = concatenate([order[start[p]:start[p+1]] for p in probes])
+      Xc = X[cand]
+
+      # Exact distances to the candidates, a chunk of points at a time
+      Q = order[start[c]:start[c+1]]
+      chunk = max([1, 2**22//len(cand)])
+      for s in range(0, len(Q), chunk):
+         q = Q[s:s+chunk]
+         d = maximum(sq[q][:,None]+sq[cand][None,:]-2*dot(X[q], Xc.T), 0)
+         if k<len(cand):
+            part = argpartition(d, k-1, axis=1)[:,:k]
+         else:
+            part = tile(arange(len(cand)), (len(q), 1))
+         dk = take_along_axis(d, part, axis=1)
+         o = argsort(dk, axis=1)
+         nn[q] = cand[take_along_axis(part, o, axis=1)]
+         nd[q] = take_along_axis(dk, o, axis=1)
+
+   return nn, nd
 # }}}
 
-# {{{ adjacency_matrix_similarity()
-# - W[i,j]=1 when the ith and jth points are neighbors.
+# {{{ knn_graph()
+# Symmetric sparse kNN graph with weight w[i,j] on the edge between the
+# point nn[i,0] and its neighbor nn[i,j+1]
+def knn_graph(nn, w):
+   n = nn.shape[0]
+   i = repeat(nn[:,0], nn.shape[1]-1)
+   j = nn[:,1:].ravel()
+   w = w.ravel()
+
+   # When nn[:,0] is not the point itself (duplicated feature vectors) the
+   # same edge can come from two rows. The edge keeps one weight, the
+   # largest, instead of the sum the sparse constructor would give.
+   key = i.astype(int64)*n+j
+   o = lexsort((-w, key))
+   key, first = unique(key[o], return_index=True)
+   W = scipy.sparse.csr_matrix((w[o][first], (key//n, key%n)), shape=(n, n))
+
+   # Mutual neighbors give the same edge twice, with the same weight
+   return W.maximum(W.T)
+# }}}
+
+# {{{ adjacency_matrix()
+# - W[i,j]=exp(-|xi-xj|^2) when the ith and jth points are neighbors.
 # - Otherwise Wij=0.
-def adjacency_matrix_similarity(X, Xt, k, ms, md):
-   # Distances
-   metric=SquaredL2
-   dist = metric.within(X)
+# W is returned as a sparse matrix.
+def adjacency_matrix(X, k, backend=None):
+   # k-nearest neighbors
+   nn, dist = nearest_neighbors(X, k, backend)
 
-   adj = zeros(dist.shape)  
+   # geodesic distance inside the manifold
+   hk = exp(-dist[:,1:])
 
-   # k-nearest neighbors
-   nn = argsort(dist)[:,:min(k+1,len(X))]
-   
-   # nn's first column is the point idx, rest are neighbor idxs
-   for idx in nn:
-      adj[idx[0],idx[1:]] = 1
-      adj[idx[1:],idx[0]] = 1
+   return knn_graph(nn, hk)
+# }}}
 
-   n = X.shape[0]
-   for i in range(n):
-      for j in range(n):
-         # geodesic distance inside the manifold
-         hk = exp(-(linalg.norm(X[i]-X[j])**2))
-         if Xt[i]==Xt[j]: 
-            hk *= ms;
-         else:
-            hk *= md;
+# {{{ adjacency_matrix_similarity()
+# - W[i,j]=exp(-|xi-xj|^2)*ms when the ith and jth points are neighbors
+#   with the same label, and exp(-|xi-xj|^2)*md when the labels differ.
+# - Otherwise Wij=0.
+# W is returned as a sparse matrix.
+def adjacency_matrix_similarity(X, Xt, k, ms, md, backend=None):
+   # k-nearest neighbors
+   nn, dist = nearest_neighbors(X, k, backend)
 
-         if adj[i,j]==1:
-            adj[i,j]*=hk
+   # geodesic distance inside the manifold
+   Xt = asarray(Xt)
+   same = Xt[nn[:,1:]]==Xt[nn[:,:1]]
+   hk = (exp(-dist[:,1:]) * where(same, ms, md)).astype(dist.dtype)
 
-   return adj
+   return knn_graph(nn, hk)
 # }}}
 
 # {{{ laplacian()
-# L=D-W
+# L=D-W. Sparse matrices give a sparse L.
 def laplacian(W):
 
+  if scipy.sparse.issparse(W):
+    # set diagonal to zero, in case it isn't already
+    W = scipy.sparse.csr_matrix(W)
+    W = W - scipy.sparse.diags(W.diagonal())
+    d = asarray(W.sum(axis=0)).ravel().astype(W.dtype)
+    return (scipy.sparse.diags(d) - W).tocsr()
+
   n_nodes = W.shape[0]
   lap = -asarray(W)  # minus sign leads to a copy
   # set diagonal to zero, in case it isn't already
@@ -150,53 +426,136 @@ def laplacian(W):
   return lap
 # }}}
 
+# {{{ svm_cache()
+def svm_cache():
+   if MODEL_CACHE:
+      return model_cache.default_cache()
+   return None
+# }}}
+
 # {{{ svm_grid_search()
-def svm_grid_search(X, Xt):
+def svm_grid_search(X, Xt, mode=None):
+
+   if mode is None:
+      mode=GRID_SEARCH_MODE
 
    # Set the parameters by cross-validation
    tuned_parameters = [{'kernel': ['rbf'], 
                          'gamma': [1e+3,1e-2,1e-1,1e-0,1e-1,1e-2,1e-3,1e-4],
                         'C': [0.25,0.5,1,10,100,10000]}]
 
-   clf = GridSearchCV(svm.SVC(C=1), tuned_parameters, n_jobs=-1)
-   clf.fit(X, Xt)
-   return clf.best_params_
-# }}}
+   if mode not in ('exhaustive', 'halving'):
+      raise ValueError("Unknown grid search mode: "+str(mode))
 
-# {{{ svm_accuracy()
-def svm_accuracy(X, Xt, Y, Yt):
+   def search():
+      if mode=='halving':
+         return svm_search.halving_search(X, Xt, tuned_parameters[0]['gamma'],
+                                          tuned_parameters[0]['C'],
+                                          n_jobs=SVM_JOBS)
 
-   n = X.shape[0]
+      clf = GridSearchCV(svm.SVC(C=1), tuned_parameters, n_jobs=SVM_JOBS)
+      clf.fit(X, Xt)
+      return clf.best_params_
+
+   return model_cache.cached(svm_cache(),
+      model_cache.key('grid_search', mode, tuned_parameters, X, Xt), search)
+# }}}
+
+# {{{ train_svm()
+# SVM of the source domain, with the parameters of the grid search
+def train_svm(X, Xt):
 
    pm=svm_grid_search(X, Xt)
-   clf=svm.SVC(kernel=pm['kernel'],C=pm['C'],gamma=pm['gamma'],probability=True)
-   clf.fit(X, Xt)
+
+   def fit():
+      clf=svm.SVC(kernel=pm['kernel'],C=pm['C'],gamma=pm['gamma'],probability=True)
+      clf.fit(X, Xt)
+      return clf
+
+   return model_cache.cached(svm_cache(),
+      model_cache.key('SVC', pm, 'probability', X, Xt), fit)
+# }}}
+
+# {{{ svm_accuracy()
+def svm_accuracy(X, Xt, Y, Yt, clf=None):
+
+   if clf is None:
+      clf=train_svm(X, Xt)
    Yt2 = clf.predict(Y)
-   
-   cnt=0
-   for i in range(n):
-      if Yt[i]==Yt2[i]:
-         cnt=cnt+1
 
-   return 100*float(cnt)/n
+   return 100*float(sum(Yt==Yt2))/len(Yt)
 # }}}
 
-# {{{ domain_adaptation()
-def domain_adaptation(X, Xt, Y, d, k1, k2, eps=1e-8):
+# {{{ smallest_eigenvectors()
+# Eigenvectors of the d smallest non-trivial eigenvalues of the Laplacian L
+# of a graph. The trivial ones, the zero eigenvalues of its connected
+# components, are skipped. labels is the component of every node.
+def smallest_eigenvectors(L, d, labels):
+
+   n = L.shape[0]
+   n_components = int(labels.max())+1
+   k = n_components+d
+
+   # LOBPCG needs a few times more nodes than vectors
+   if n < 5*(k+4):
+      vals,vecs = scipy.linalg.eigh(L.toarray())
+      idx = argsort(vals)
+      return vecs[:,idx[n_components:k]].astype(L.dtype)
+
+   # The zero eigenvectors are known: the normalised indicators of the
+   # components. The search is constrained to their orthogonal complement.
+   Z = zeros((n, n_components))
+   Z[arange(n), labels] = 1
+   Z /= sqrt(Z.sum(axis=0))
+
+   # A complete factorisation of L, as shift-invert needs, fills in almost
+   # completely on kNN graphs. The degrees span several orders of magnitude
+   # (the source graph weights are 1000 times larger), so a diagonal
+   # preconditioner is not enough either: an incomplete LU with a bounded
+   # fill-in is used instead.
+   A = L.astype(float64)
+   ilu = scipy.sparse.linalg.spilu(
+      (A+1e-3*scipy.sparse.identity(n)).tocsc(),
+      drop_tol=EIGEN_ILU_DROP, fill_factor=EIGEN_ILU_FILL)
+   M = scipy.sparse.linalg.LinearOperator((n, n), matvec=ilu.solve,
+                                          matmat=ilu.solve, dtype=float64)
+
+   # A fixed start block makes the new coordinates, and so their cached
+   # SVMs, reproducible. Four more vectors than needed speed up convergence.
+   X0 = random.RandomState(0).uniform(-1, 1, (n, d+4))
+   vals,vecs = scipy.sparse.linalg.lobpcg(A, X0, M=M, Y=Z, largest=False,
+                                          tol=1e-6, maxiter=1000)
+   idx = argsort(vals)
+   return vecs[:,idx[:d]].astype(L.dtype)
+# }}}
 
-   n = X.shape[0]
+# {{{ source_graph()
+# Graph of the source domain, with the labels
+def source_graph(X, Xt, k):
+   return adjacency_matrix_similarity(X, Xt, k, 1000, 0.0010)
+# }}}
 
+# {{{ target_graph()
+def target_graph(Y, k):
+   return adjacency_matrix(Y, k)
+# }}}
 
-   pm=svm_grid_search(X, Xt)
-   clf=svm.SVC(kernel=pm['kernel'],C=pm['C'],gamma=pm['gamma'],probability=True)
-   clf.fit(X, Xt)
+# {{{ domain_adaptation()
+# The source SVM and the graphs of both domains are computed here unless
+# given, so a batch of pairs can share them (see run_pairs.py)
+def domain_adaptation(X, Xt, Y, d, k1, k2, clf=None, Wx=None, Wy=None):
+
+   n1=X.shape[0]
+   n2=Y.shape[0]
+
+   if clf is None:
+      clf=train_svm(X, Xt)
 
    Ty = clf.predict(Y)
    Py = clf.predict_proba(Y)
    Py = array([a for (a, b) in Py])
-   Iy = array([i for i in range(n)])
-   zipped=zip(Py, Ty, Iy)   
-   zipped.sort()
+   Iy = array([i for i in range(n2)])
+   zipped=sorted(zip(Py, Ty, Iy))
    Py = array([a for (a, b, c) in zipped])
    Ty = array([b for (a, b, c) in zipped])
    Iy = array([c for (a, b, c) in zipped])
@@ -204,40 +563,35 @@ def domain_adaptation(X, Xt, Y, d, k1, k2, eps=1e-8):
    Tx = clf.predict(X)
    Px = clf.predict_proba(X)
    Px = array([a for (a, b) in Px])
-   Ix = array([i for i in range(n)])
-   zipped=zip(Px, Tx, Ix)   
-   zipped.sort()
+   Ix = array([i for i in range(n1)])
+   zipped=sorted(zip(Px, Tx, Ix))
    Px = array([a for (a, b, c) in zipped])
    Tx = array([b for (a, b, c) in zipped])
    Ix = array([c for (a, b, c) in zipped])
    
    # Local geometry (min cost)
-   Wx = adjacency_matrix_similarity(X, Xt, k1, 1000, 0.0010)
-   Wy = adjacency_matrix(Y, k1)
-   Wxy = zeros(shape=(n,n)) 
-   for i in range(n):
-      # We can not use geodesic distance because they are in different manifolds
-      Wxy[Ix[i], Iy[i]]=1
-
-   W=asarray(bmat(((Wx, Wxy),(Wxy.T, Wy))))
+   if Wx is None:
+      Wx = source_graph(X, Xt, k1)
+   if Wy is None:
+      Wy = target_graph(Y, k1)
+
+   # We can not use geodesic distance because they are in different manifolds
+   m = min([n1, n2])
+   Wxy = scipy.sparse.csr_matrix((ones(m, dtype=Wx.dtype), (Ix[:m], Iy[:m])),
+                                 shape=(n1,n2))
+
+   W = scipy.sparse.bmat(((Wx, Wxy),(Wxy.T, Wy)), format='csr')
    Ll = laplacian(W)
 
    # Linear algebra
-   #vals,vecs = scipy.linalg.eig(A, B)
-   vals,vecs = scipy.linalg.eig(Ll)
-   idx = argsort(vals)
-   for i in xrange(len(idx)):
-      if vals[idx[i]] >= eps:
-         break
-   vecs = vecs.real[:,idx[i:]]
+   _, labels = connected_components(W, directed=False)
+   vecs = smallest_eigenvectors(Ll, d, labels)
 
    # Normalization
-   for i in xrange(vecs.shape[1]):
+   for i in range(vecs.shape[1]):
       vecs[:,i] /= linalg.norm(vecs[:,i])
 
    # New Coordinates
-   n1=X.shape[0]
-   n2=Y.shape[0]
    map1 = vecs[ : n1, : d]
    map2 = vecs[n1 : n1+n2, : d]
 
@@ -249,20 +603,31 @@ def domain_adaptation(X, Xt, Y, d, k1, k2, eps=1e-8):
 
 if __name__ == '__main__':
 
-   if len(sys.argv)!=3:
-      print("Usage: <fea src> <fea dst>")
+   argv, dt = pop_dtype_arg(sys.argv)
+   if dt is not None:
+      FLOAT_DTYPE=dt
+
+   if len(argv) not in (3, 4):
+      print("Usage: [--dtype float32|float64] <fea src> <fea dst> [full|auto|kd_tree|ball_tree|brute|approximate]")
+      print("A <fea> is a CSV file, '-' for the standard input, or CSV files "
+            "separated by '%s' read as one set" % os.pathsep)
       sys.exit(0)
+
+   if len(argv)==4:
+      NEIGHBORS=argv[3]
     
-   d=2 # dimensions
-   X, Xt = read_features(sys.argv[1])
-   Y, Yt = read_features(sys.argv[2])
+   d=DIMENSIONS
+   X, Xt = read_features(argv[1])
+   Y, Yt = read_features(argv[2])
    k1=int(round(sqrt(X.shape[0])))
    k2=k1 # number of neighbors
-   noDA_acc = svm_accuracy(X, Xt, Y, Yt)
-   Xnew, Ynew = domain_adaptation(X, Xt, Y, d, k1, k2)
+   clf = train_svm(X, Xt)
+   noDA_acc = svm_accuracy(X, Xt, Y, Yt, clf)
+   Xnew, Ynew = domain_adaptation(X, Xt, Y, d, k1, k2, clf)
    DA_acc = svm_accuracy(Xnew, Xt, Ynew, Yt)
 
    print("no Da:",noDA_acc, " DA:",DA_acc)
+   memory.report_peak_memory(dtype(FLOAT_DTYPE).name)
  
 
 
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+# Cross-domain evaluation of a batch of (source, destination) pairs with
+# MA_PPD.py, in a single job:
+#
+#   ./run_pairs.py [--pairs <file>] [--dimensions 2,3] [--neighbors 22,30]
+#                  [--processes N] [--dtype float32|float64]
+#                  [--output <file>] [<fea csv> ...]
+#
+# Without --pairs all the ordered pairs of the given CSV files (data/*.csv
+# by default) are evaluated. A pairs file has one "<fea src> <fea dst>" per
+# line. Every pair is run with every combination of dimensions and number
+# of neighbors (by default DIMENSIONS and the square root of the size of
+# the source domain).
+#
+# Every domain is read once, and the SVM of every source domain and the
+# graphs of every domain are computed once and shared by all the pairs and
+# parameters that use them. Both stages run in a pool of MAX_PROC processes.
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import argparse
+import multiprocessing
+
+from numpy import *
+
+import MA_PPD
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'common'))
+import memory
+
+# Domains, source SVMs and graphs, filled before the pools are started so
+# the workers inherit them
+DOMAINS={}
+SOURCE_SVM={}
+SOURCE_GRAPH={}
+TARGET_GRAPH={}
+
+# {{{ domain_name()
+def domain_name(fea_file):
+   return os.path.splitext(os.path.basename(fea_file))[0]
+# }}}
+
+# {{{ read_pairs()
+def read_pairs(pairs_file):
+   pairs=[]
+   for l in open(pairs_file, 'r').read().splitlines():
+      l=l.strip()
+      if len(l)==0 or l.startswith('#'):
+         continue
+      fields=l.split()
+      if len(fields)!=2:
+         raise ValueError("Expected '<fea src> <fea dst>': "+l)
+      pairs.append((fields[0], fields[1]))
+   return pairs
+# }}}
+
+# {{{ default_neighbors()
+def default_neighbors(src):
+   return int(round(sqrt(DOMAINS[src][0].shape[0])))
+# }}}
+
+# {{{ shared_task()
+# Runs in the workers. SVM of a source domain or graph of a domain.
+def shared_task(task):
+   kind, f, k = task
+   X, Xt = DOMAINS[f]
+   if kind=='svm':
+      return task, MA_PPD.train_svm(X, Xt)
+   if kind=='source':
+      return task, MA_PPD.source_graph(X, Xt, k)
+   return task, MA_PPD.target_graph(X, k)
+# }}}
+
+# {{{ pair_task()
+# Runs in the workers. Accuracy of a pair after the domain adaptation.
+def pair_task(task):
+   src, dst, d, k = task
+   X, Xt = DOMAINS[src]
+   Y, Yt = DOMAINS[dst]
+
+   Xnew, Ynew = MA_PPD.domain_adaptation(X, Xt, Y, d, k, k,
+                                         SOURCE_SVM[src],
+                                         SOURCE_GRAPH[(src, k)],
+                                         TARGET_GRAPH[(dst, k)])
+   return task, MA_PPD.svm_accuracy(Xnew, Xt, Ynew, Yt)
+# }}}
+
+# {{{ run_tasks()
+# Results of the tasks, in a pool when there is more than one process
+def run_tasks(fn, tasks, processes):
+
+   if processes<=1 or len(tasks)<=1:
+      return dict(map(fn, tasks))
+
+   # The workers must be forked: they read DOMAINS and the shared graphs
+   # and SVMs from the memory of the parent
+   pool=multiprocessing.get_context('fork').Pool(min([processes, len(tasks)]))
+   try:
+      return dict(pool.imap_unordered(fn, tasks))
+   finally:
+      pool.close()
+      pool.join()
+# }}}
+
+# {{{ run_pairs()
+# Rows (src, dst, d, k, no DA accuracy, DA accuracy) of all the pairs with
+# all the parameters
+def run_pairs(pairs, dimensions, neighbors=None, processes=None):
+
+   if processes is None:
+      processes=MA_PPD.MAX_PROC
+
+   # The pools already use the CPUs
+   if processes>1:
+      MA_PPD.SVM_JOBS=1
+
+   for f in sorted(set([f for p in pairs for f in p])):
+      if f not in DOMAINS:
+         DOMAINS[f]=MA_PPD.read_features(f)
+
+   runs=[]
+   for src, dst in pairs:
+      for k in (neighbors or [default_neighbors(src)]):
+         for d in dimensions:
+            runs.append((src, dst, d, k))
+
+   shared=set()
+   for src, dst, d, k in runs:
+      shared.add(('svm', src, None))
+      shared.add(('source', src, k))
+      shared.add(('target', dst, k))
+   shared=sorted(shared, key=lambda t: (t[0], t[1], t[2] or 0))
+
+   for (kind, f, k), r in run_tasks(shared_task, shared, processes).items():
+      if kind=='svm':
+         SOURCE_SVM[f]=r
+      elif kind=='source':
+         SOURCE_GRAPH[(f, k)]=r
+      else:
+         TARGET_GRAPH[(f, k)]=r
+
+   noDA={}
+   for src, dst in pairs:
+      Y, Yt = DOMAINS[dst]
+      noDA[(src, dst)]=MA_PPD.svm_accuracy(None, None, Y, Yt, SOURCE_SVM[src])
+
+   DA=run_tasks(pair_task, runs, processes)
+
+   return [(src, dst, d, k, noDA[(src, dst)], DA[(src, dst, d, k)])
+           for src, dst, d, k in runs]
+# }}}
+
+# {{{ print_table()
+def print_table(rows, out=sys.stdout):
+   w=int(max([len(domain_name(f)) for r in rows for f in r[:2]]+[3]))
+   print("%-*s  %-*s  %3s  %3s  %7s  %7s" % (w, "src", w, "dst", "d", "k",
+                                             "no DA", "DA"), file=out)
+   for src, dst, d, k, noDA_acc, DA_acc in rows:
+      print("%-*s  %-*s  %3d  %3d  %7.2f  %7.2f" % (w, domain_name(src),
+            w, domain_name(dst), d, k, noDA_acc, DA_acc), file=out)
+# }}}
+
+# {{{ int_list()
+def int_list(s):
+   return [int(v) for v in s.split(',')]
+# }}}
+
+
+
+if __name__ == '__main__':
+
+   parser=argparse.ArgumentParser()
+   parser.add_argument("fea", nargs='*',
+                       help="feature files, all their ordered pairs are run")
+   parser.add_argument("--pairs", help="file with '<fea src> <fea dst>' lines")
+   parser.add_argument("--dimensions", type=int_list,
+                       default=[MA_PPD.DIMENSIONS])
+   parser.add_argument("--neighbors", type=int_list)
+   parser.add_argument("--processes", type=int, default=MA_PPD.MAX_PROC)
+   parser.add_argument("--dtype", choices=['float32', 'float64'],
+                       default=dtype(MA_PPD.FLOAT_DTYPE).name,
+                       help="type of the features, graphs and eigenvectors")
+   parser.add_argument("--output", help="also write the table to this file")
+   args=parser.parse_args()
+   MA_PPD.FLOAT_DTYPE=dtype(args.dtype).type
+
+   if args.pairs:
+      pairs=read_pairs(args.pairs)
+   else:
+      files=args.fea or sorted(glob.glob(os.path.join(
+         os.path.dirname(os.path.abspath(__file__)), 'data', '*.csv')))
+      pairs=[(a, b) for a in files for b in files if a!=b]
+
+   if len(pairs)==0:
+      print("No pairs to run")
+      sys.exit(0)
+
+   rows=run_pairs(pairs, args.dimensions, args.neighbors, args.processes)
+
+   print_table(rows)
+   if args.output:
+      with open(args.output, 'w') as f:
+         print_table(rows, f)
+
+   memory.report_peak_memory(dtype(MA_PPD.FLOAT_DTYPE).name)
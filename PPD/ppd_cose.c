@@ -1,120 +1,115 @@
 
 /* Compilation:
-   $ gcc ppd_cose.c -ltiff
+   $ gcc -O2 ppd_cose.c -ltiff -lpthread
+
+   Usage:
+   $ ./a.out [-n <realizations>] [-s <seed>] [-v] <input tiff file>
+   $ ./a.out -b [-j <threads>] [-n <realizations>] [-s <seed>] [-v] [<list file>]
+
+   The ratio features are averaged over n random embeddings of the image
+   (1 by default), all counted in the same pass. Embedding k of the image
+   uses the seed <seed>+k (the seed is the current time by default). With
+   -v the variance of the ratio over the realizations is appended to the
+   features.
+
+   In batch mode the list file (or the standard input, when no file is
+   given) has one "<tiff file> [<label>]" per line. The features of all the
+   images are written to the standard output as CSV, one row per image in
+   the order of the list, followed by the label (or the file name when
+   there is no label), which is the format read by MA_PPD. Image i of the
+   list uses the seed <seed>+i*n.
 */
 
 
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <time.h>
+#include <unistd.h>
+#include <pthread.h>
 #include <tiffio.h>
 #include <libgen.h>
 
 #define S 4
+#define N_FEATURES (S*S*S*S)
 
+// Rows per thread kept in memory by the batch mode until they are written
+#define BATCH_WINDOW 64
 
-// {{{ matrix_alloc()
-int **matrix_alloc(size_t cols, size_t rows)
+
+// {{{ image_read()
+// Read a grayscale TIFF image into a contiguous row-major buffer
+unsigned char *image_read(const char *path, size_t *cols, size_t *rows)
 {
-	int i, j;
-	int **m = (int**)malloc(sizeof(m) * cols);
-	if(!m) 
-	{
-		perror("out of memory (cols)");
+	uint32 y, h;
+
+	TIFF* tif_i = TIFFOpen(path, "r");
+	if (!tif_i)
 		return NULL;
-	}
 
-	for(i=0; i<cols; i++)
+	TIFFGetField(tif_i, TIFFTAG_IMAGELENGTH, &h);
+	*rows = h;
+	*cols = TIFFScanlineSize(tif_i);
+
+	unsigned char *I = (unsigned char*)malloc((*cols) * (*rows));
+	if(!I)
 	{
-		m[i] = (int*)malloc(sizeof(m[i]) * rows);
-		if(!m[i])
-		{
-			perror("out of memory (rows)");
-			return NULL;
-		}
+		perror("out of memory");
+		TIFFClose(tif_i);
+		return NULL;
 	}
 
-	for(j=0; j<rows; j++)
-		for(i=0; i<cols; i++)
-			m[i][j]=0;
+	for (y = 0; y < h; y++)
+		TIFFReadScanline(tif_i, I + y*(*cols), y, 0);
 
-	return m;
-}
-// }}}
-
-// {{{ matrix_free()
-void matrix_free(int **m, size_t cols, size_t rows)
-{
-	int x;
-	for(x=0; x<cols; x++)
-		free(m[x]);
-	free(m);
-}
-// }}}
-
-// {{{ matrix_copy()
-void matrix_copy(int **mdst, int **msrc, size_t cols, size_t rows)
-{
-	int i, j;
-	for(j=0; j<rows; j++)
-	{
-		for(i=0; i<cols; i++)
-		{
-			mdst[i][j] = msrc[i][j];
-		}
-	}
+	TIFFClose(tif_i);
+	return I;
 }
 // }}}
 
-// {{{ message_hide_random_br()
-// Hide a random message with especified bitrate
-void message_hide_random_br(
-	int **matrix, size_t cols, size_t rows, float bitrate)
+// {{{ message_hide_random_br_row()
+// Hide a random message with especified bitrate into a row of pixels.
+// Called for every row in order, it draws the same random numbers as
+// the embedding of the whole image.
+void message_hide_random_br_row(unsigned char *dst, const unsigned char *src,
+	size_t cols, float bitrate, unsigned int *seed)
 {
 	int br=1/bitrate;
-	int i, j;
-	for(j=0; j<rows; j++)
+	size_t i;
+	for(i=0; i<cols; i++)
 	{
-		for(i=0; i<cols; i++)
+		int p = src[i];
+		if((p<255)&&(p>0))
 		{
-			if((matrix[i][j]<255)&&(matrix[i][j]>0))
+			//  0 or 1?
+			int bit = rand_r(seed)%2;
+
+			// + or -?
+			int s = -1;
+			if(rand_r(seed)%2==0)
+				s = 1;
+
+			// Bit insertion
+			if(rand_r(seed)%br==0)
 			{
-				//  0 or 1?
-				int bit = rand()%2;
-
-				// + or -?
-				int s = -1;
-				if(rand()%2==0)
-					s = 1;
-
-				// Bit insertion
-				if(rand()%br==0) 
-				{
-					if(bit==0 && matrix[i][j]%2==1)
-						matrix[i][j] += s;
-
-					if(bit==1 && matrix[i][j]%2==0)
-						matrix[i][j] += s;
-				}
+				if(bit==0 && p%2==1)
+					p += s;
+
+				if(bit==1 && p%2==0)
+					p += s;
 			}
 		}
+		dst[i] = p;
 	}
 }
 // }}}
 
-// {{{ count_patterns()
-void count_patterns(int shapes[S][S][S][S], int **I, int cols, int rows)
+// {{{ count_pattern()
+// Count the min and max patterns of one neighbourhood
+static inline void count_pattern(int shapes[S][S][S][S],
+	int _a, int _b, int _c, int _d, int _e)
 {
-	int i, j, k, l, x, y;
-
-	// initialize shapes
-	for(i=0; i<S; i++)
-		for(j=0; j<S; j++)
-			for(k=0; k<S; k++)
-				for(l=0; l<S; l++)
-					shapes[i][j][k][l]=0;
-
 	// a b
 	// c d
 	// . e
@@ -123,154 +118,449 @@ void count_patterns(int shapes[S][S][S][S], int **I, int cols, int rows)
 	//     \ /
 	//  l - m - r
 
+	int l=0, r=0, c1=0, c2=0;
+	int mn = 256;
+	int mx=0;
+	if(_a<mn) { mn=_a; l=_b; r=_c; c1=_d; c2=_e; }
+	if(_b<mn) { mn=_b; l=_d; r=_a; c1=_c; c2=_e; }
+	if(_c<mn) { mn=_c; l=_a; r=_e; c1=_b; c2=_d; }
+	if(_d<mn) { mn=_d; l=_e; r=_b; c1=_c; c2=_a; }
+	if(_e<mn) { mn=_e; l=_c; r=_d; c1=_a; c2=_b; }
+
+	int i1 = (l-mn>=S?S-1:l-mn);
+	int i2 = (c1-mn>=S?S-1:c1-mn);
+	int i3 = (c2-mn>=S?S-1:c2-mn);
+	int i4 = (r-mn>=S?S-1:r-mn);
+
+	shapes[i1][i2][i3][i4]++;
+
+	if(_a>mx) { mx = _a; l=_b; r=_c; c1=_d; c2=_e; }
+	if(_b>mx) { mx = _b; l=_d; r=_a; c1=_c; c2=_e; }
+	if(_c>mx) { mx = _c; l=_a; r=_e; c1=_b; c2=_d; }
+	if(_d>mx) { mx = _d; l=_e; r=_b; c1=_c; c2=_a; }
+	if(_e>mx) { mx = _e; l=_c; r=_d; c1=_a; c2=_b; }
+
+	i1 = (mx-l>=S?S-1:mx-l);
+	i2 = (mx-c1>=S?S-1:mx-c1);
+	i3 = (mx-c2>=S?S-1:mx-c2);
+	i4 = (mx-r>=S?S-1:mx-r);
+
+	shapes[i1][i2][i3][i4]++;
+}
+// }}}
+
+// {{{ count_patterns()
+// Count the patterns of the cover image I and of n versions of I with a
+// random message in a single row-major pass. The stego images are never
+// stored: their rows are embedded on the fly into rings of three rows.
+// Realization k uses the random state seeds[k].
+int count_patterns(int shapes[S][S][S][S], int shapes_s[][S][S][S][S], int n,
+	const unsigned char *I, size_t cols, size_t rows, float bitrate,
+	unsigned int *seeds)
+{
+	size_t x, y;
+	int k;
+
+	// initialize shapes
+	memset(shapes, 0, sizeof(int)*N_FEATURES);
+	memset(shapes_s, 0, sizeof(int)*N_FEATURES*n);
+
+	if(rows<3 || cols<2)
+		return 0;
+
+	unsigned char *rings = (unsigned char*)malloc(3*cols*n);
+	if(!rings)
+	{
+		perror("out of memory");
+		return -1;
+	}
+
+	for(k=0; k<n; k++)
+	{
+		unsigned char *ring = rings+3*cols*k;
+		message_hide_random_br_row(ring, I, cols, bitrate, &seeds[k]);
+		message_hide_random_br_row(ring+cols, I+cols, cols, bitrate, &seeds[k]);
+	}
+
 	for(y=1; y<rows-1; y++)
 	{
+		for(k=0; k<n; k++)
+			message_hide_random_br_row(rings+3*cols*k+((y+1)%3)*cols,
+				I+(y+1)*cols, cols, bitrate, &seeds[k]);
+
+		const unsigned char *p = I+(y-1)*cols;
+		const unsigned char *c = I+y*cols;
+		const unsigned char *nx = I+(y+1)*cols;
+
 		for(x=0; x<cols-1; x++)
 		{
-			int _a = I[x][y-1];
-			int _b = I[x+1][y-1];
-			int _c = I[x][y];
-			int _d = I[x+1][y];
-			int _e = I[x+1][y+1];
-
-			int l=0, r=0, c1=0, c2=0;
-			int mn = 256;
-			int mx=0;
-			if(_a<mn) { mn=_a; l=_b; r=_c; c1=_d; c2=_e; }
-			if(_b<mn) { mn=_b; l=_d; r=_a; c1=_c; c2=_e; }
-			if(_c<mn) { mn=_c; l=_a; r=_e; c1=_b; c2=_d; }
-			if(_d<mn) { mn=_d; l=_e; r=_b; c1=_c; c2=_a; }
-			if(_e<mn) { mn=_e; l=_c; r=_d; c1=_a; c2=_b; }
-
-			int i1 = (l-mn>=S?S-1:l-mn);
-			int i2 = (c1-mn>=S?S-1:c1-mn);
-			int i3 = (c2-mn>=S?S-1:c2-mn);
-			int i4 = (r-mn>=S?S-1:r-mn);
-	
-			shapes[i1][i2][i3][i4]++;
-
-			if(_a>mx) { mx = _a; l=_b; r=_c; c1=_d; c2=_e; }
-			if(_b>mx) { mx = _b; l=_d; r=_a; c1=_c; c2=_e; }
-			if(_c>mx) { mx = _c; l=_a; r=_e; c1=_b; c2=_d; }
-			if(_d>mx) { mx = _d; l=_e; r=_b; c1=_c; c2=_a; }
-			if(_e>mx) { mx = _e; l=_c; r=_d; c1=_a; c2=_b; }
-
-			i1 = (mx-l>=S?S-1:mx-l);
-			i2 = (mx-c1>=S?S-1:mx-c1);
-			i3 = (mx-c2>=S?S-1:mx-c2);
-			i4 = (mx-r>=S?S-1:mx-r);
-
-			shapes[i1][i2][i3][i4]++;
+			count_pattern(shapes, p[x], p[x+1], c[x], c[x+1], nx[x+1]);
+
+			for(k=0; k<n; k++)
+			{
+				const unsigned char *ring = rings+3*cols*k;
+				const unsigned char *ps = ring+((y-1)%3)*cols;
+				const unsigned char *cs = ring+(y%3)*cols;
+				const unsigned char *ns = ring+((y+1)%3)*cols;
+				count_pattern(shapes_s[k], 
+					ps[x], ps[x+1], cs[x], cs[x+1], ns[x+1]);
+			}
 		}
 	}
 
+	free(rings);
+	return 0;
 }
 // }}}
 
-
-int main(int argc, char* argv[])
+// {{{ ppd_features()
+// Features of the image in path: the mean of the ratios of the n
+// realizations, followed by their variance if variance!=0. R must have
+// room for N_FEATURES (or 2*N_FEATURES with variance) values.
+int ppd_features(float *R, const char *path, int n, int variance,
+	unsigned int seed)
 {
-	uint32 rows;
-	tsize_t cols;
-	tdata_t buf;
-	uint32 x;
-	uint32 y;
+	size_t cols, rows;
+	int i, k;
 
+	unsigned char *I = image_read(path, &cols, &rows);
+	if(!I)
+		return -1;
 
-	if(argc!=2)
+	int shapes[S][S][S][S];
+	int (*shapes_s)[S][S][S][S] = malloc(sizeof(*shapes_s)*n);
+	unsigned int *seeds = (unsigned int*)malloc(sizeof(unsigned int)*n);
+	float *Rk = (float*)malloc(sizeof(float)*N_FEATURES*n);
+	if(!shapes_s || !seeds || !Rk)
 	{
-		printf("Usage: %s <input tiff file>\n", argv[0]);
+		perror("out of memory");
+		free(I); free(shapes_s); free(seeds); free(Rk);
 		return -1;
 	}
 
-	srand(time(NULL));
-	//srand(0);
+	for(k=0; k<n; k++)
+		seeds[k] = seed+k;
 
-	TIFF* tif_i = TIFFOpen(argv[1], "r");
-	if (!tif_i) 
+	int ret = count_patterns(shapes, shapes_s, n, I, cols, rows, 1, seeds);
+	free(I);
+	free(seeds);
+	if(ret!=0)
 	{
-		printf("Error reading Tiff image\n");
-		return -1;
+		free(shapes_s);
+		free(Rk);
+		return ret;
 	}
 
-	TIFFGetField(tif_i, TIFFTAG_IMAGELENGTH, &rows);
-	cols = TIFFScanlineSize(tif_i);
-	buf = _TIFFmalloc(cols);
+	int *cover = &shapes[0][0][0][0];
+	for(k=0; k<n; k++)
+	{
+		int *stego = &shapes_s[k][0][0][0][0];
+		float *r = Rk+k*N_FEATURES;
+		float mx=0;
+		float mn=10;
+
+		for(i=0; i<N_FEATURES; i++)
+		{
+			float f=0;
+			if(cover[i]>0)
+				f = (float)stego[i] / (float)cover[i];
+
+			if(f>mx) mx=f;
+			if(f<mn) mn=f;
 
+			r[i]=f;
+		}
 
-	// Matrix I
-	int **I = matrix_alloc(cols, rows);
+		for(i=0; i<N_FEATURES; i++)
+			r[i] = (r[i]-mn)/(mx-mn);
+	}
 
-	for (y = 0; y < rows; y++)
+	for(i=0; i<N_FEATURES; i++)
 	{
-		TIFFReadScanline(tif_i, buf, y, 0);
-		for (x = 0; x < cols; x++)
+		float mean=0, var=0;
+		for(k=0; k<n; k++)
+			mean += Rk[k*N_FEATURES+i];
+		mean /= n;
+
+		for(k=0; k<n; k++)
 		{
-			unsigned char *bytes = buf;
-			I[x][y]=bytes[x];
+			float d = Rk[k*N_FEATURES+i]-mean;
+			var += d*d;
 		}
+		var /= n;
+
+		R[i] = mean;
+		if(variance)
+			R[N_FEATURES+i] = var;
 	}
 
-	_TIFFfree(buf);
-	TIFFClose(tif_i);
+	free(shapes_s);
+	free(Rk);
+	return 0;
+}
+// }}}
 
+// {{{ batch
+typedef struct
+{
+	char **files;
+	char **labels;
+	float *R;         // n_features values per row of the window
+	int *status;      // per row of the window, 0: pending, 1: done, -1: error
+	int window;       // rows computed but not written yet, at most
+	int n;
+	int next;         // next image to process
+	int next_print;   // next row to write
+	int errors;
+	int realizations;
+	int variance;
+	int n_features;
+	unsigned int seed;
+	pthread_mutex_t lock;
+	pthread_cond_t printed;
+} batch_t;
+
+// {{{ batch_print()
+// Write the rows that are ready, in the order of the list, and free their
+// slots of the window. Called with the lock held.
+void batch_print(batch_t *b)
+{
+	int i;
+	while(b->next_print < b->n && b->status[b->next_print%b->window]!=0)
+	{
+		int r = b->next_print;
+		int w = r%b->window;
+		if(b->status[w]==1)
+		{
+			for(i=0; i<b->n_features; i++)
+				printf("%f,", b->R[w*b->n_features+i]);
+			printf("%s\n", b->labels[r]?b->labels[r]:basename(b->files[r]));
+		}
+		else
+		{
+			fprintf(stderr, "Error reading Tiff image: %s\n", b->files[r]);
+			b->errors++;
+		}
 
-	int i, j, k, l;
-	
+		b->status[w] = 0;
+		b->next_print++;
+	}
+	fflush(stdout);
+	pthread_cond_broadcast(&b->printed);
+}
+// }}}
 
-	int shapes[S][S][S][S];
-	int shapes_s[S][S][S][S];
-	
+// {{{ batch_worker()
+void *batch_worker(void *arg)
+{
+	batch_t *b = (batch_t*)arg;
+	float R[2*N_FEATURES];
 
-	// Create Is, inserting a random message
-	int **Is = matrix_alloc(cols, rows);
-	matrix_copy(Is, I, cols, rows);
-	message_hide_random_br(Is, cols, rows, 1);
+	for(;;)
+	{
+		pthread_mutex_lock(&b->lock);
+		int i = b->next++;
+		// A slow image holds back the rows after it. Wait until the row of
+		// this image fits in the window instead of keeping all of them.
+		while(i < b->n && i >= b->next_print+b->window)
+			pthread_cond_wait(&b->printed, &b->lock);
+		pthread_mutex_unlock(&b->lock);
+
+		if(i >= b->n)
+			break;
+
+		// The seed depends only on the position in the list, so the
+		// results do not depend on the scheduling of the threads
+		int ret = ppd_features(R, b->files[i], b->realizations, b->variance,
+			b->seed+(unsigned int)i*b->realizations);
+
+		pthread_mutex_lock(&b->lock);
+		memcpy(b->R+(i%b->window)*b->n_features, R,
+			sizeof(float)*b->n_features);
+		b->status[i%b->window] = (ret==0?1:-1);
+		batch_print(b);
+		pthread_mutex_unlock(&b->lock);
+	}
 
+	return NULL;
+}
+// }}}
 
-	count_patterns(shapes, I, cols, rows);
-	count_patterns(shapes_s, Is, cols, rows);
+// {{{ batch_read_list()
+// Read the "<file> [<label>]" lines of the list. Returns -1 when there is not
+// enough memory.
+int batch_read_list(FILE *f, batch_t *b)
+{
+	char line[4096];
+	int size = 1024;
 
+	b->n = 0;
+	b->files = (char**)malloc(size*sizeof(char*));
+	b->labels = (char**)malloc(size*sizeof(char*));
+	if(!b->files || !b->labels)
+		return -1;
 
-	float R[S*S*S*S];
-	float mx=0;
-	float mn=10;
-	int idx=0;
+	while(fgets(line, sizeof(line), f))
+	{
+		char *file = strtok(line, " \t\r\n");
+		if(!file)
+			continue;
+		char *label = strtok(NULL, " \t\r\n");
 
-	for(i=0; i<S; i++)
-		for(j=0; j<S; j++)
-			for(k=0; k<S; k++)
-				for(l=0; l<S; l++)
-			{
+		if(b->n == size)
+		{
+			char **files = (char**)realloc(b->files, 2*size*sizeof(char*));
+			if(files)
+				b->files = files;
+			char **labels = (char**)realloc(b->labels, 2*size*sizeof(char*));
+			if(labels)
+				b->labels = labels;
+			if(!files || !labels)
+				return -1;
+			size *= 2;
+		}
+		b->files[b->n] = strdup(file);
+		b->labels[b->n] = label?strdup(label):NULL;
+		if(!b->files[b->n] || (label && !b->labels[b->n]))
+		{
+			free(b->files[b->n]);
+			free(b->labels[b->n]);
+			return -1;
+		}
+		b->n++;
+	}
+
+	return b->n;
+}
+// }}}
+
+// {{{ batch_run()
+int batch_run(FILE *list, int n_threads, int realizations, int variance,
+	unsigned int seed)
+{
+	batch_t b;
+	int i;
 
-				float f=0;
-				float cover = (float)shapes[i][j][k][l];
-				float stego = (float)shapes_s[i][j][k][l];
+	if(batch_read_list(list, &b)<0)
+	{
+		perror("out of memory");
+		return -1;
+	}
+	b.realizations = realizations;
+	b.variance = variance;
+	b.n_features = (variance?2:1)*N_FEATURES;
+	b.window = BATCH_WINDOW*n_threads;
+	b.R = (float*)malloc(sizeof(float)*b.n_features*b.window);
+	b.status = (int*)calloc(b.window, sizeof(int));
+	pthread_t *threads = (pthread_t*)malloc(n_threads*sizeof(pthread_t));
+	if(!b.R || !b.status || !threads)
+	{
+		perror("out of memory");
+		return -1;
+	}
+	b.next = 0;
+	b.next_print = 0;
+	b.errors = 0;
+	b.seed = seed;
+	pthread_mutex_init(&b.lock, NULL);
+	pthread_cond_init(&b.printed, NULL);
+
+	for(i=0; i<n_threads; i++)
+		pthread_create(&threads[i], NULL, batch_worker, &b);
+	for(i=0; i<n_threads; i++)
+		pthread_join(threads[i], NULL);
+
+	for(i=0; i<b.n; i++)
+	{
+		free(b.files[i]);
+		free(b.labels[i]);
+	}
 
+	pthread_cond_destroy(&b.printed);
+	pthread_mutex_destroy(&b.lock);
+	free(threads);
+	free(b.files);
+	free(b.labels);
+	free(b.R);
+	free(b.status);
 
-				if(cover>0)
-					f = stego / cover;
+	return b.errors>0?-1:0;
+}
+// }}}
+// }}}
 
-				if(f>mx) mx=f;
-				if(f<mn) mn=f;
 
-				R[idx++]=f;
+int main(int argc, char* argv[])
+{
+	int i, opt;
+	int batch = 0;
+	int n_threads = sysconf(_SC_NPROCESSORS_ONLN);
+	int realizations = 1;
+	int variance = 0;
+	unsigned int seed = time(NULL);
+
+	while((opt = getopt(argc, argv, "bj:n:s:v")) != -1)
+	{
+		switch(opt)
+		{
+			case 'b': batch = 1; break;
+			case 'j': n_threads = atoi(optarg); break;
+			case 'n': realizations = atoi(optarg); break;
+			case 's': seed = strtoul(optarg, NULL, 10); break;
+			case 'v': variance = 1; break;
+			default: argc = 0;
+		}
+	}
+	if(n_threads<1)
+		n_threads = 1;
+
+	if(argc==0 || realizations<1 || (!batch && optind!=argc-1))
+	{
+		printf("Usage: %s [-n <realizations>] [-s <seed>] [-v] <input tiff file>\n", 
+			argv[0]);
+		printf("       %s -b [-j <threads>] [-n <realizations>] [-s <seed>] [-v] [<list file>]\n", 
+			argv[0]);
+		return -1;
+	}
+
+	// Batch mode
+	if(batch)
+	{
+		FILE *list = stdin;
+		if(optind<argc && strcmp(argv[optind], "-")!=0)
+		{
+			list = fopen(argv[optind], "r");
+			if(!list)
+			{
+				perror(argv[optind]);
+				return -1;
 			}
+		}
+
+		int ret = batch_run(list, n_threads, realizations, variance, seed);
+		if(list!=stdin)
+			fclose(list);
+		return ret;
+	}
 
-	for(i=0; i<idx; i++)
-		printf("%f ", (R[i]-mn)/(mx-mn));
+	float R[2*N_FEATURES];
+	if(ppd_features(R, argv[optind], realizations, variance, seed)!=0)
+	{
+		printf("Error reading Tiff image\n");
+		return -1;
+	}
 
+	for(i=0; i<(variance?2:1)*N_FEATURES; i++)
+		printf("%f ", R[i]);
 
-	printf("%s\n", basename(argv[1]));
 
-	matrix_free(I, cols, rows);
-	matrix_free(Is, cols, rows);
+	printf("%s\n", basename(argv[optind]));
 
 	return 0;
 }
 
 
-	 
+
 
 
 
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+# Peak memory of the memory bound scripts (ATS and MA_PPD), so the float32
+# and float64 data paths can be compared.
+
+from __future__ import print_function
+import sys
+import resource
+
+
+# {{{ peak_memory_mb()
+# Maximum resident set size of this process and of its finished children,
+# in MB. ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+def peak_memory_mb():
+    scale=1024.0*1024.0 if sys.platform=='darwin' else 1024.0
+    own=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+    children=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/scale
+    return own, children
+# }}}
+
+# {{{ report_peak_memory()
+def report_peak_memory(mode, out=sys.stderr):
+    own, children=peak_memory_mb()
+    print("Peak memory (%s): %.1f MB, %.1f MB in child processes"
+          % (mode, own, children), file=out)
+# }}}
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Content-addressed on-disk cache of grid search results and fitted models,
+# shared by ATS and MA_PPD.
+#
+# Entries are pickled to <cache dir>/<key>.pkl, where the key is the
+# SHA-256 of everything the value depends on: the training matrix, the
+# labels, the parameter grid and the version of scikit-learn. The same data
+# always gives the same key, so reruns of an experiment skip the search and
+# the fit. Reading an entry updates its modification time and the least
+# recently used entries are removed when the cache grows over its size.
+#
+# Entries are loaded with pickle, which can run arbitrary code: the cache
+# directory must only be writable by trusted users. Do not point
+# MODEL_CACHE_DIR to a shared or world writable location.
+
+from __future__ import print_function
+import os
+import sys
+import glob
+import pickle
+import hashlib
+import numpy
+import sklearn
+
+
+# >> CONFIGURATION >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+# Directory of the cache (MODEL_CACHE_DIR in the environment)
+CACHE_DIR=os.environ.get('MODEL_CACHE_DIR',
+                         os.path.join(os.path.expanduser('~'), '.cache',
+                                      'ppd_models'))
+
+# Maximum size of the cache in bytes (MODEL_CACHE_SIZE in the environment)
+MAX_BYTES=int(os.environ.get('MODEL_CACHE_SIZE', 2**30))
+
+
+# <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+
+# {{{ update_hash()
+# Feed a value to a hash. Arrays are hashed by type, shape and contents,
+# dicts independently of their order.
+def update_hash(h, value):
+    if isinstance(value, numpy.ndarray):
+        value=numpy.ascontiguousarray(value)
+        h.update(("ndarray %s %r;" % (value.dtype.str, value.shape)).encode())
+        h.update(memoryview(value).cast('B'))
+    elif isinstance(value, dict):
+        h.update(b"dict{")
+        for k in sorted(value.keys(), key=repr):
+            update_hash(h, k)
+            update_hash(h, value[k])
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        h.update(("%s[" % type(value).__name__).encode())
+        for v in value:
+            update_hash(h, v)
+        h.update(b"]")
+    else:
+        h.update(("%s %r;" % (type(value).__name__, value)).encode())
+# }}}
+
+# {{{ key()
+def key(*parts):
+    h=hashlib.sha256()
+    update_hash(h, ('sklearn', sklearn.__version__))
+    for p in parts:
+        update_hash(h, p)
+    return h.hexdigest()
+# }}}
+
+# {{{ ModelCache
+class ModelCache(object):
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory=directory or CACHE_DIR
+        self.max_bytes=MAX_BYTES if max_bytes is None else max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, k):
+        return os.path.join(self.directory, k+".pkl")
+
+    # Value of a key, default when it is not in the cache or can not be
+    # read. Entries that can not be loaded are removed.
+    def get(self, k, default=None):
+        path=self.path(k)
+        try:
+            with open(path, 'rb') as f:
+                value=pickle.load(f)
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            print("Model cache entry %s removed: %s" % (k, e), file=sys.stderr)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return default
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    # Writes go to a file of this process, renamed when complete, so
+    # concurrent workers never read a partial entry
+    def put(self, k, value):
+        path=self.path(k)
+        tmp="%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        self.evict()
+
+    # Remove the least recently used entries until the cache fits in
+    # max_bytes
+    def evict(self):
+        entries=[]
+        for path in glob.glob(os.path.join(self.directory, "*.pkl")):
+            try:
+                st=os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total=sum(size for t, size, path in entries)
+        for t, size, path in sorted(entries):
+            if total<=self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total-=size
+
+    def size(self):
+        return sum(os.path.getsize(p) for p in
+                   glob.glob(os.path.join(self.directory, "*.pkl")))
+# }}}
+
+# {{{ cached()
+# Value of a key, computed with compute() and stored when it is not in the
+# cache. Without a cache compute() is always called.
+_MISSING=object()
+
+def cached(cache, k, compute):
+    if cache is None:
+        return compute()
+
+    value=cache.get(k, _MISSING)
+    if value is _MISSING:
+        value=compute()
+        try:
+            cache.put(k, value)
+        except OSError as e:
+            print("Model cache not written:", e, file=sys.stderr)
+    return value
+# }}}
+
+# {{{ default_cache()
+# Cache in CACHE_DIR, None when it can not be created
+def default_cache():
+    try:
+        return ModelCache()
+    except OSError as e:
+        print("Model cache disabled:", e, file=sys.stderr)
+        return None
+# }}}
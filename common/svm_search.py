@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Hyperparameter search for the RBF SVMs used by ATS and MA_PPD.
+#
+# halving_search() is a coarse-to-fine alternative to the exhaustive
+# GridSearchCV: every (gamma, C) cell is first evaluated on a small
+# stratified subsample, only the best 1/eta of them survive to the next
+# round, which uses eta times more samples, and the survivors are finally
+# evaluated and refined around the best cell on the full data.
+
+from __future__ import print_function
+import sys
+import math
+import numpy
+from sklearn import svm
+from sklearn.model_selection import cross_val_score
+
+
+# {{{ stratified_subsample()
+def stratified_subsample(y, size, random_state):
+
+    idx=[]
+    classes=numpy.unique(y)
+    for c in classes:
+        members=numpy.where(y==c)[0]
+        m=max(1, int(round(size*float(len(members))/len(y))))
+        idx.append(random_state.choice(members, min(m, len(members)),
+                                       replace=False))
+    return numpy.sort(numpy.concatenate(idx))
+# }}}
+
+# {{{ cv_score()
+def cv_score(X, y, gamma, C, n_folds, n_jobs):
+    clf=svm.SVC(kernel='rbf', gamma=gamma, C=C)
+    return numpy.mean(cross_val_score(clf, X, y, cv=n_folds, n_jobs=n_jobs))
+# }}}
+
+# {{{ halving_search()
+def halving_search(X, y, gammas, Cs, n_folds=5, eta=3, min_samples=100,
+                   refine=True, n_jobs=None, seed=0, verbose=True):
+
+    y=numpy.asarray(y)
+    n=len(y)
+    gammas=sorted(set(gammas), key=gammas.index)
+    Cs=sorted(set(Cs), key=Cs.index)
+    candidates=[(g, C) for g in gammas for C in Cs]
+    exhaustive_fits=len(candidates)*n_folds
+    rs=numpy.random.RandomState(seed)
+    fits=0
+    subsample_fits=0
+
+    # Coarse rounds on growing subsamples. The number of rounds is chosen
+    # so that the last one is done on the full data set.
+    rounds=int(math.ceil(math.log(len(candidates), eta)))
+    size=max(min_samples, int(n/eta**rounds))
+    while size<n and len(candidates)>1:
+        idx=stratified_subsample(y, size, rs)
+        if min(numpy.bincount(y[idx]))<n_folds:
+            size*=eta
+            continue
+
+        scores=[]
+        for g, C in candidates:
+            scores.append(cv_score(X[idx], y[idx], g, C, n_folds, n_jobs))
+            subsample_fits+=n_folds
+
+        order=numpy.argsort(scores, kind='mergesort')[::-1]
+        keep=int(math.ceil(len(candidates)/float(eta)))
+        candidates=[candidates[i] for i in order[:keep]]
+        size*=eta
+
+    # Fine round on the full data: the survivors and, if requested, the
+    # neighbourhood of the best of them at half a decade in each direction.
+    scores={}
+    for g, C in candidates:
+        scores[(g, C)]=cv_score(X, y, g, C, n_folds, n_jobs)
+        fits+=n_folds
+
+    if refine:
+        g0, C0=max(candidates, key=lambda p: scores[p])
+        for fg in [10**-0.5, 1, 10**0.5]:
+            for fC in [10**-0.5, 1, 10**0.5]:
+                p=(g0*fg, C0*fC)
+                if p not in scores:
+                    scores[p]=cv_score(X, y, p[0], p[1], n_folds, n_jobs)
+                    fits+=n_folds
+
+    best_score=-1
+    best_params={}
+    for g, C in sorted(scores.keys()):
+        if scores[(g, C)]>best_score:
+            best_score=scores[(g, C)]
+            best_params={'kernel': 'rbf', 'gamma': g, 'C': C}
+
+    if verbose:
+        print("Halving search: %d fits on the full data and %d on "
+              "subsamples, the exhaustive search does %d on the full data"
+              % (fits, subsample_fits, exhaustive_fits), file=sys.stderr)
+
+    return best_params
+# }}}